@@ -0,0 +1,57 @@
+# Fixed corpus of Canadian address parts for the normalization benchmarks.
+# It is built from the lists below in a fixed order, so every run (and the
+# stored baseline) measures exactly the same inputs.
+
+import itertools
+
+STREET_NAMES = [
+    '17 Avenue', 'Macleod Trail', 'Centre Street', 'Crowchild Trail', 'Elbow Drive',
+    'Yonge Street', 'Bloor St.', 'Queen Street', 'Dundas St', 'Spadina Ave.',
+    'Jasper Avenue', 'Whyte Ave', 'Portage Avenue', 'Pembina Hwy', 'Robson St',
+    'Granville Street', 'Kingsway', 'Main Street', 'Lakeshore Road', 'Sherbrooke St',
+    'Sunnyside Crescent', 'Maple Grove Close', 'Hidden Valley Heights', 'Evergreen Circle',
+    'Royal Oak Gardens', 'Tuscany Ravine Terrace', 'Bridlewood Place', 'Prospect Hill',
+    'Mount Royal Gate', 'Cedar Lane', 'Pine Court', 'Birch Bay', 'Aspen Park Landing',
+    'Country Hills Boulevard', 'Glenmore Parkway', 'Sarcee Trail', 'Deerfoot Tr',
+    'Victoria Rd', 'Wellington Blvd', 'Highway 2', 'Range Road 33', 'Township Rd 250',
+]
+
+QUEBEC_STREET_NAMES = [
+    'Rue Saint-Denis', 'Rue Sainte-Catherine Ouest', 'Boulevard René-Lévesque Est',
+    'Chemin de la Côte-des-Neiges', 'Avenue du Parc', 'Av. du Mont-Royal Est',
+    'Rue de la Commune', 'Boul. Saint-Laurent', 'Montée Saint-Michel', 'Côte du Palais',
+    'Place Jacques-Cartier', 'Rang Saint-Joseph', 'Ruelle des Fortifications',
+    'Promenade Samuel-De Champlain', 'Carré Saint-Louis', 'Rue Notre-Dame O',
+]
+
+DIRECTIONS = ['', ' SW', ' NE', ' NW', ' SE', ' North', ' South-West', ' East', ' W']
+
+HOUSE_NUMBERS = [
+    '4515', '12', '7', '1203', '88B', '12b', '310A', '11 1/2', '24 1/2', '5 1/2',
+    '12-345', '#4 1203', 'Unit 5 22', '3-1410', '1410-3', '103A,103B', '1206 1,1206 2',
+    '15;17', '20 22 24', '100-', '(2) 45', '45 (2)', '0.5', '.5', '12.5', '7 A',
+    '200 Suite 5', 'A-12', '1A-12', '4515-4521', '14 & 16', '9/11',
+]
+
+POSTCODES = [
+    't2g0a1', 'T2G 0A1', 'M5V3L9', 'm5v 3l9', 'H3B-4W8', 'V6B 1A1 ', ' K1A0B1',
+    'R3C4T3', 'S4P 3Y2', 'E1C 4M2', 'B3H 4R2', 'A1C 5M2', 'X1A 2P7', 'T5J',
+]
+
+
+def street_names():
+    return [name + direction for name in STREET_NAMES + QUEBEC_STREET_NAMES for direction in DIRECTIONS]
+
+
+def house_numbers():
+    # Every house number with a handful of the streets it is parsed against
+    return list(itertools.product(HOUSE_NUMBERS, STREET_NAMES[:8] + QUEBEC_STREET_NAMES[:4]))
+
+
+def postcodes():
+    return POSTCODES * 20
+
+
+def full_addresses():
+    # Addresses as ca_postcodes builds them: "<street_no> <street>, <city>, <region>"
+    return [f"{house_no} {street}, Calgary, AB" for house_no, street in itertools.product(HOUSE_NUMBERS[:10], street_names())]
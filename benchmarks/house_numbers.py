@@ -0,0 +1,79 @@
+# Regression check of osm2mrag.extract_parts. house_numbers.jsonl holds
+# (house number, street name, expected result) for a fixed set of inputs:
+# hand-picked spellings of house numbers and units, plus inputs generated from
+# them with a seeded random generator. The expected results were produced by
+# extract_parts before its patterns were compiled into HOUSE_NO_RULES.
+#
+#   python house_numbers.py           # compare extract_parts with the expected results
+#   python house_numbers.py --write   # store the results of the current code, after a deliberate rule change
+
+import os
+import sys
+import json
+import random
+import argparse
+
+from normalization import load_script
+
+CASES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'house_numbers.jsonl')
+
+SEEDS = [
+    '4515', '12B', '12b', '0', '007', '11 1/2', '103A,103B', '1206 1,1206 2', '12-14', '12 - 14', 'A-12',
+    'unit 5, 123', 'Unit 5 123', '123 unit 4', '#4-123', '#4', '#4 12B', ', 123', ' 12', '12 ', '12-', '12a-',
+    '1...5-7', '12 A-B', '12 B', '12 ab', '12 34 56', '12(A)', '12 (b)', '12[a]', '12[3]', '.5', '0.5', '12.5',
+    '1.2.3', '"12"', "12'", '12`', '12;14', '12/14', '12&14', '12,14', '', '-', '  ', 'Ⅻ', '١٢', '12½', '12_',
+    '½', '12A3', '1UNIT', 'unit', 'UNIT A', '12, unit 3', '12 Unit 3B', '12-A', '5 - ', '1 2 3 4', '100A 100B',
+    '12,  14B', '12 ,14', 'x', 'abc', '1a-2b', '12-14-16', '0 .5', 'A', '12a 3b', '12 ab cd', '1–2', '12 1/2',
+    '12  1/2', '12 3/4', '#', '# 12', '12 A', '12  A', '١', '²', '12²', '12ß', '12ı', '12ſ',
+]
+CHARS = '0123456789 AaBbUuNnIiTt#-,/;&.()[]"\'`½'
+STREETS = [None, '', 'Main St', '12 Main St', '4B Elm Ave', '  7 x', '12ab Rd']
+SEPARATORS = ['', ' ', '-', ',', '/', ' ,']
+
+# The seeds, random strings of CHARS and pairs of seeds, each with a street name
+def generate_cases(count=20000, seed=3):
+    rnd = random.Random(seed)
+    house_numbers = list(SEEDS)
+    for _ in range(count):
+        if rnd.random() < .5:
+            house_numbers.append(''.join(rnd.choice(CHARS) for _ in range(rnd.randint(0, 9))))
+        else:
+            house_numbers.append(rnd.choice(SEEDS) + rnd.choice(SEPARATORS) + rnd.choice(SEEDS))
+    return [(house_no, rnd.choice(STREETS)) for house_no in house_numbers]
+
+# ['ok', result] or ['error', name of the exception], as stored in the file
+def outcome(function, house_no, street_name):
+    try:
+        return ['ok', json.loads(json.dumps(function(house_no, street_name)))]
+    except Exception as e:
+        return ['error', type(e).__name__]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check extract_parts against the expected results")
+    parser.add_argument('--write', action='store_true', help="store the results of the current code as expected")
+    args = parser.parse_args()
+
+    osm2mrag = load_script('osm2mrag_main', 'osm2mrag')
+
+    if args.write:
+        with open(CASES_PATH, 'w', encoding='utf-8') as file:
+            for house_no, street_name in generate_cases():
+                result = outcome(osm2mrag.extract_parts, house_no, street_name)
+                file.write(json.dumps([house_no, street_name, result], ensure_ascii=False) + '\n')
+        print(f"Wrote the expected results to {CASES_PATH}")
+        sys.exit(0)
+
+    checked = 0
+    mismatches = 0
+    with open(CASES_PATH, encoding='utf-8') as file:
+        for line in file:
+            house_no, street_name, expected = json.loads(line)
+            result = outcome(osm2mrag.extract_parts, house_no, street_name)
+            checked += 1
+            if result != expected:
+                mismatches += 1
+                if mismatches <= 20:
+                    print(f"{house_no!r} {street_name!r}: expected {expected}, got {result}")
+    print(f"{checked} inputs, {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
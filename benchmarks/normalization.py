@@ -0,0 +1,144 @@
+# Micro-benchmarks of the address normalization hot paths of osm2mrag and
+# ca_postcodes over the fixed corpus in corpus.py. No database is needed.
+#
+#   python normalization.py --save-baseline   # record the baseline of this machine
+#   python normalization.py                   # compare against it
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib.util
+
+import corpus
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Both importers are called main.py, so they are loaded under their own names
+def load_script(name, directory):
+    sys.path.append(os.path.join(ROOT, directory))
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, directory, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def with_street_types(module, street_types, function):
+    # expand_address_abbreviations reads the rule set from the module global
+    def call(*args):
+        saved = module.STREET_TYPES
+        module.STREET_TYPES = street_types
+        try:
+            return function(*args)
+        finally:
+            module.STREET_TYPES = saved
+    return call
+
+# (name, function, list of argument tuples)
+def benchmarks():
+    osm2mrag = load_script('osm2mrag_main', 'osm2mrag')
+    ca_postcodes = load_script('ca_postcodes_main', 'ca_postcodes')
+    # Measure the normalization itself, not the LRU caches in front of it
+    osm2mrag.set_street_cache_size(0)
+    ca_postcodes.STREET_CACHE.resize(0)
+
+    streets = [(street,) for street in corpus.street_names()]
+    addresses = [(address,) for address in corpus.full_addresses()]
+    return [
+        ('exchange_address_abbreviations', osm2mrag.exchange_address_abbreviations, streets),
+        ('convert_direction', osm2mrag.convert_direction, streets),
+        ('extract_parts', osm2mrag.extract_parts, corpus.house_numbers()),
+        ('format_postal_code', osm2mrag.format_postal_code, [(postcode,) for postcode in corpus.postcodes()]),
+        ('expand_address_abbreviations', with_street_types(ca_postcodes, ca_postcodes.STREET_TYPES, ca_postcodes.expand_address_abbreviations), addresses),
+        ('expand_address_abbreviations (Quebec)', with_street_types(ca_postcodes, ca_postcodes.QUEBEC_STREET_TYPES, ca_postcodes.expand_address_abbreviations), addresses),
+    ]
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+def call_all(function, inputs):
+    for args in inputs:
+        try:
+            function(*args)
+        except Exception:
+            # Some house numbers are rejected by extract_parts, that is part of the work
+            pass
+
+# ops/sec is the best of `rounds` rounds over the corpus, each repeating it
+# for at least min_seconds; the latency percentiles come from one more pass
+# that times every call on its own
+def measure(function, inputs, rounds, min_seconds=0.2):
+    start = time.perf_counter()
+    call_all(function, inputs)  # warm up
+    repeat = max(1, int(min_seconds / max(time.perf_counter() - start, 1e-9)))
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            call_all(function, inputs)
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+
+    latencies = []
+    for args in inputs:
+        start = time.perf_counter_ns()
+        call_all(function, (args,))
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+    latencies.sort()
+    return {
+        'calls': len(inputs),
+        'ops_per_sec': len(inputs) / best,
+        'p50_us': percentile(latencies, 0.50),
+        'p95_us': percentile(latencies, 0.95),
+        'p99_us': percentile(latencies, 0.99),
+    }
+
+# Names of the functions whose ops/sec dropped more than threshold percent below the baseline
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, result in results.items():
+        if name in baseline and result['ops_per_sec'] < baseline[name]['ops_per_sec'] * (1 - threshold / 100):
+            slower.append(name)
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the address normalization functions")
+    parser.add_argument('--rounds', type=int, default=5, help="passes over the corpus, the fastest one counts")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline file to compare against or to save")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="fail when a function is more than this many percent slower than the baseline")
+    parser.add_argument('--filter', default='', help="only run the functions whose name contains this text")
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = {}
+    print(f"{'function':40} {'calls':>6} {'ops/sec':>12} {'p50 us':>8} {'p95 us':>8} {'p99 us':>8} {'vs baseline':>12}")
+    for name, function, inputs in benchmarks():
+        if args.filter not in name:
+            continue
+        result = measure(function, inputs, args.rounds)
+        results[name] = result
+        change = ''
+        if name in baseline:
+            change = f"{result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1:+.1%}"
+        print(f"{name:40} {result['calls']:>6} {result['ops_per_sec']:>12,.0f} {result['p50_us']:>8.1f} "
+              f"{result['p95_us']:>8.1f} {result['p99_us']:>8.1f} {change:>12}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+    else:
+        slower = regressions(results, baseline, args.threshold)
+        if slower:
+            print(f"Slower than the baseline by more than {args.threshold}%: {', '.join(slower)}")
+            sys.exit(1)
+        print(f"No function is slower than the baseline by more than {args.threshold}%")
@@ -0,0 +1,78 @@
+# Checks that the column-wise transform of osm2mrag (--transform columns, the
+# default) gives the same addresses as the row by row one (--transform rows)
+# on pages of rows generated from corpus.py, including rows with missing or
+# empty fields, and that it fails on the same pages. Exits with status 1 on
+# the first page that differs.
+#
+#   python transform_equivalence.py
+
+import sys
+import random
+import argparse
+
+import corpus
+from normalization import load_script
+
+# Values that break a row are rare (one row in `odd_every`), so most pages
+# go through and their addresses are compared
+def generate_rows(count, seed=3, odd_every=5000):
+    rnd = random.Random(seed)
+    streets = corpus.street_names() + ['', '  ']
+    house_numbers = corpus.HOUSE_NUMBERS + [str(i) for i in range(1, 400)] + ['12-', 'unit 5, 123']
+    postcodes = corpus.POSTCODES + [None, '', 'T2P']
+    rows = []
+    for osm_id in range(1, count + 1):
+        odd = rnd.randrange(odd_every) == 0
+        rows.append({
+            'osm_id': osm_id,
+            'street': None if odd else rnd.choice(streets),
+            'postcode': rnd.choice(postcodes),
+            'housenumber': rnd.choice([None, '']) if odd else rnd.choice(house_numbers),
+            'state': rnd.choice([None, '', 'AB', 'QC']),
+            'province': rnd.choice([None, '', 'Alberta', 'Quebec']),
+            'city': rnd.choice([None, '', 'Calgary', 'Montréal']),
+            'longitude': -114.0 + rnd.random(),
+            'latitude': 51.0 + rnd.random(),
+            'way': None,
+        })
+    return rows
+
+# The addresses of the page, or None when it raised. A page with several bad
+# rows may fail on another row, and so with another exception, column by column.
+def transform(function, rows):
+    try:
+        return function(rows)
+    except Exception:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the row and the column transform of osm2mrag")
+    parser.add_argument('--rows', type=int, default=50000, help="generated rows")
+    parser.add_argument('--page-size', type=int, default=1000, help="rows per page")
+    args = parser.parse_args()
+
+    osm2mrag = load_script('osm2mrag_main', 'osm2mrag')
+    # Both transforms call the same normalization functions, without the caches
+    # neither reuses what the other computed
+    osm2mrag.set_street_cache_size(0)
+    rows = generate_rows(args.rows)
+    pages = 0
+    failed = 0
+    for start in range(0, len(rows), args.page_size):
+        page = rows[start:start + args.page_size]
+        by_rows = transform(lambda page: osm2mrag.transform_page(page, columnar=False), page)
+        by_columns = transform(lambda page: osm2mrag.transform_page(page, columnar=True), page)
+        if by_rows != by_columns:
+            print(f"The page of osm_id {page[0]['osm_id']} to {page[-1]['osm_id']} differs")
+            if by_rows is not None and by_columns is not None:
+                for expected, result in zip(by_rows, by_columns):
+                    if expected != result:
+                        print(f"  rows:    {expected}\n  columns: {result}")
+                        break
+            else:
+                print(f"  rows: {'failed' if by_rows is None else 'ok'}, columns: {'failed' if by_columns is None else 'ok'}")
+            sys.exit(1)
+        pages += 1
+        failed += by_rows is None
+    print(f"{pages} pages of {args.page_size} rows, rows and columns give the same addresses "
+          f"({failed} pages failed with both)")
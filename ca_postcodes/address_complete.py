@@ -0,0 +1,154 @@
+# Client of the find/retrieve endpoints of Canada Post AddressComplete, the
+# service behind the search box of https://www.canadapost-postescanada.ca/ac/.
+# The suggestions come back as JSON, so no browser is needed: one aiohttp
+# session keeps the connections open and at most `concurrency` requests run at
+# the same time. The suggestions are matched with the rules of
+# main._read_postal_code, which uses the same functions below.
+
+import re
+import json
+import asyncio
+
+import aiohttp
+
+DEFAULT_URL = 'https://ws1.postescanada-canadapost.ca'
+FIND_PATH = '/AddressComplete/Interactive/Find/v2.10/json3.ws'
+RETRIEVE_PATH = '/AddressComplete/Interactive/Retrieve/v2.11/json3.ws'
+
+# The service did not answer; unlike an error item, these say nothing about the request
+SERVICE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# Error numbers of the key or the account (unknown key, out of credit, daily
+# limit, IP or URL not allowed, service not on the key or plan, agreement not
+# signed, version not supported, key suspended, demo limit), after which no
+# request can succeed. The others (surge protector, errors of the request)
+# concern the address being looked up.
+FATAL_ERRORS = {2, 3, 4, 5, 6, 7, 8, 11, 12, 13, 14, 17}
+
+# Containers (Next == 'Find', e.g. a street or a building with its units) are
+# opened with a second find, down to this many levels
+CONTAINER_DEPTH = 2
+
+class AddressCompleteError(Exception):
+    """An error item returned by AddressComplete.
+
+    ``fatal`` errors are those of ``FATAL_ERRORS``, which stop the run; after
+    the others only the address goes back to the queue.
+    """
+
+    def __init__(self, number, description, cause):
+        super().__init__(f"AddressComplete error {number}: {description} ({cause})")
+        self.number = number
+        self.description = description
+        self.cause = cause
+
+    @property
+    def fatal(self):
+        return self.number in FATAL_ERRORS
+
+# The title of a suggestion is the street address, the description starts with "City, Region, "
+def title_matches(title, full_address, street_full_name):
+    title = title.strip().lower()
+    return full_address.strip().lower() in title or title == street_full_name.strip().lower()
+
+# The postal code right after city_region in the description, or None
+def postal_code_from_description(description, city_region):
+    if city_region not in description:
+        return None
+    pattern = f"^.*{re.escape(city_region)}"
+    description = re.sub(pattern, "", description, flags=re.IGNORECASE).strip()
+    # Regex pattern to match the postal code format at the end of the string
+    match = re.search(r"^(\w{3}\s\w{3})\s*", description, flags=re.IGNORECASE)
+    if match:
+        return match.group(0).strip().upper()
+    return None
+
+class AddressCompleteClient:
+    """Async client of the AddressComplete find and retrieve endpoints.
+
+    Use it as ``async with AddressCompleteClient(key) as client``. ``base_url``
+    points it at another server, e.g. ``recorded_server.py``; with
+    ``record_path`` every response is saved there when the client closes, in
+    the format that server replays.
+    """
+
+    def __init__(self, key, base_url=DEFAULT_URL, concurrency=8, timeout=10, record_path=None):
+        self.key = key
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.record_path = record_path
+        self.recordings = {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        self.requests = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        if self.record_path:
+            with open(self.record_path, 'w', encoding='utf-8') as file:
+                json.dump(self.recordings, file, indent=2, ensure_ascii=False)
+
+    async def _get(self, path, params):
+        async with self.semaphore:
+            self.requests += 1
+            async with self.session.get(self.base_url + path, params=dict(params, Key=self.key)) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        if self.record_path:
+            self.recordings[recording_key(path, params)] = data
+        items = data.get('Items', [])
+        # Errors come back with status 200, as the only item, with the number as a string
+        if len(items) == 1 and 'Error' in items[0]:
+            error = items[0]
+            number = int(error['Error']) if str(error['Error']).isdigit() else error['Error']
+            raise AddressCompleteError(number, error.get('Description'), error.get('Cause'))
+        return items
+
+    # The suggestions of search_term, or with container the items inside that container
+    async def find(self, search_term, container=None, country='CAN'):
+        params = {'SearchTerm': search_term, 'Country': country, 'LanguagePreference': 'en'}
+        if container:
+            params['LastId'] = container
+        return await self._get(FIND_PATH, params)
+
+    async def retrieve(self, item_id):
+        return await self._get(RETRIEVE_PATH, {'Id': item_id})
+
+    # Postal code of the first suggestion that matches, or None. A matching
+    # address whose description has no postal code is retrieved, a matching
+    # container is opened.
+    async def lookup(self, address, full_address, street_full_name, city_region,
+                     container=None, depth=CONTAINER_DEPTH):
+        for item in await self.find(address, container):
+            if not title_matches(item.get('Text', ''), full_address, street_full_name):
+                continue
+            description = item.get('Description', '')
+            if item.get('Next') == 'Find':
+                # The description of a container is "City, Region - 12 Addresses"
+                if depth > 0 and city_region.rstrip(', ') in description:
+                    postal_code = await self.lookup(address, full_address, street_full_name, city_region,
+                                                    item['Id'], depth - 1)
+                    if postal_code:
+                        return postal_code
+                continue
+            if city_region not in description:
+                continue
+            postal_code = postal_code_from_description(description, city_region)
+            if postal_code:
+                return postal_code
+            if item.get('Next') == 'Retrieve':
+                for retrieved in await self.retrieve(item['Id']):
+                    if retrieved.get('PostalCode'):
+                        return retrieved['PostalCode'].strip().upper()
+        return None
+
+# Requests are recorded by endpoint and parameters, without the key
+def recording_key(path, params):
+    return path + '?' + '&'.join(f"{name}={params[name]}" for name in sorted(params) if name != 'Key')
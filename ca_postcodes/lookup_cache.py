@@ -0,0 +1,80 @@
+# Results of past lookups in a local SQLite file, so a rerun or a retry does
+# not look up an address again. The key is the address after
+# expand_address_abbreviations plus whether the Quebec rules expanded it; a
+# postal code is kept for found_ttl_days, an address without one (stored as
+# NULL) for missing_ttl_days.
+
+import time
+import sqlite3
+import threading
+
+DAY_SECONDS = 24 * 60 * 60
+
+class LookupCache:
+    """Postal codes by normalized address, shared by the lookup threads.
+
+    ``get`` returns ``(hit, postal_code)``: a hit with ``None`` is an address
+    that was looked up and had no postal code.
+    """
+
+    def __init__(self, path, found_ttl_days=365, missing_ttl_days=30):
+        self.path = path
+        self.found_ttl = found_ttl_days * DAY_SECONDS
+        self.missing_ttl = missing_ttl_days * DAY_SECONDS
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Several scrapers on one host may share the file
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS lookups (
+                query TEXT NOT NULL,
+                quebec INTEGER NOT NULL,
+                postal_code TEXT NULL,
+                looked_up_at REAL NOT NULL,
+                PRIMARY KEY (query, quebec)
+            )
+        """)
+        self.purge()
+
+    # Drop the entries whose TTL is over
+    def purge(self):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                DELETE FROM lookups
+                WHERE (postal_code IS NOT NULL AND looked_up_at < ?)
+                OR (postal_code IS NULL AND looked_up_at < ?)
+            """, (now - self.found_ttl, now - self.missing_ttl))
+
+    def get(self, query, quebec):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT postal_code, looked_up_at FROM lookups WHERE query = ? AND quebec = ?",
+                (query, int(quebec))).fetchone()
+            if row is not None:
+                postal_code, looked_up_at = row
+                ttl = self.found_ttl if postal_code is not None else self.missing_ttl
+                if looked_up_at >= time.time() - ttl:
+                    self.hits += 1
+                    return True, postal_code
+            self.misses += 1
+            return False, None
+
+    def put(self, query, quebec, postal_code):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO lookups (query, quebec, postal_code, looked_up_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (query, quebec) DO UPDATE
+                SET postal_code = excluded.postal_code, looked_up_at = excluded.looked_up_at
+            """, (query, int(quebec), postal_code, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1%} hit rate) in {self.path}"
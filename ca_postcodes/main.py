@@ -1,15 +1,27 @@
 import os
 import re
+import sys
 import time
+import asyncio
+import argparse
+import socket
+import threading
 from dotenv import load_dotenv
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import WebDriverException, TimeoutException
 import psycopg2
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared_python'))
+import street_normalizer
+import run_metrics
+import work_queue
+import address_complete
+import waits
+import lookup_cache
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -19,13 +31,29 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 CHROMEDRIVER_PATH = os.getenv('CHROMEDRIVER_PATH')  # Path to chromedriver.exe
-CONN = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+ADDRESS_COMPLETE_KEY = os.getenv('ADDRESS_COMPLETE_KEY')  # Key of the AddressComplete service, for --backend http
+# Every lookup thread has its own connection, see run_lookup_worker
+CONNECTIONS = threading.local()
+
+# The connection is opened on first use, so the normalization functions can be
+# imported (e.g. by the benchmarks) without a database
+def get_connection():
+    conn = getattr(CONNECTIONS, 'conn', None)
+    if conn is None:
+        conn = CONNECTIONS.conn = psycopg2.connect(
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=DB_PORT
+            )
+    return conn
+
+def close_connection():
+    conn = getattr(CONNECTIONS, 'conn', None)
+    if conn is not None:
+        conn.close()
+        CONNECTIONS.conn = None
 
 # Extracted list from https://www.gimme-shelter.com/steet-types-designations-abbreviations-50006/
 # Also provided a pdf in the docs forlder for reference. 
@@ -527,6 +555,11 @@ QUEBEC_REPLACEMENTS = {
 
 # Define directions
 DIRECTIONS = ['E', 'N', 'W', 'S', 'NE', 'NW', 'SE', 'SW']
+DIRECTIONS_SET = frozenset(DIRECTIONS)
+
+# Compiled street type lookups, the Quebec one is selected in select_canadian_region
+STREET_TYPES = street_normalizer.StreetTypeTable(REPLACEMENTS, ignore_case=True)
+QUEBEC_STREET_TYPES = street_normalizer.StreetTypeTable(REPLACEMENTS, overrides=QUEBEC_REPLACEMENTS, ignore_case=True)
 
 # Define the function to clean the address
 def clean_address(unit, full_address):
@@ -541,13 +574,14 @@ def clean_address(unit, full_address):
         full_address = re.sub(pattern, '', full_address, flags=re.IGNORECASE).strip()
     return full_address
 
-# Database connection and pagination
-def get_addresses_from_db(selected_region, limit=1000, offset=0):    
-    cur = CONN.cursor()
+# The search strings of claimed queue items, see work_queue
+def get_claimed_addresses(queue_ids):
+    cur = get_connection().cursor()
     cur.execute(
-        f"""
+        """
             WITH processed_addresses AS (
                 SELECT
+                    id,
                     street_no,
                     street_full_name,
                     city,
@@ -580,10 +614,11 @@ def get_addresses_from_db(selected_region, limit=1000, offset=0):
                         WHEN street_full_name ~* '\\bwst\\b$' THEN regexp_replace(street_full_name, '\\bwst\\b$', 'W', 'gi')
                         ELSE street_full_name
                     END AS processed_street_full_name
-                FROM public.mrag_ca_addresses
-                WHERE postal_code IS NULL AND is_valid = true AND region = '{selected_region}'
+                FROM mrag_postal_code_queue
+                WHERE id = ANY(%s)
             )
-            SELECT DISTINCT
+            SELECT
+                id,
                 concat(
                     street_no, 
                     ' ', 
@@ -609,15 +644,15 @@ def get_addresses_from_db(selected_region, limit=1000, offset=0):
                 region
             FROM processed_addresses
             ORDER BY full_address DESC
-            LIMIT {limit} OFFSET {offset}
-        """)
+        """, (list(queue_ids),))
     addresses = cur.fetchall()
     cur.close()
     return addresses
 
 
-def update_postal_code_in_db(street_no, street_full_name, city, region, postal_code):
-    cur = CONN.cursor()
+# Write the result of one address and mark its queue item done in the same transaction
+def update_postal_code_in_db(street_no, street_full_name, city, region, postal_code, queue_id=None):
+    cur = get_connection().cursor()
     if postal_code is None:
         if street_no is None:
             cur.execute("""
@@ -659,127 +694,156 @@ def update_postal_code_in_db(street_no, street_full_name, city, region, postal_c
     updated_rows = cur.rowcount
     if updated_rows == 0:
         raise Exception("No rows were updated: ", street_no, street_full_name, city, region, postal_code)
-    CONN.commit()
+    if queue_id is not None:
+        work_queue.finish_address(cur, queue_id, postal_code)
+    get_connection().commit()
     cur.close()
     return updated_rows    
 
-def create_driver():
+def create_driver(headless=True):
     options = webdriver.ChromeOptions()
-    options.add_experimental_option("detach", True)
-    # options.headless = True
+    if headless:
+        options.add_argument("--headless=new")
+        options.add_argument("--window-size=1280,1024")
+    else:
+        options.add_experimental_option("detach", True)
     options.add_experimental_option("excludeSwitches", ["enable-logging"])
     service = Service(executable_path=CHROMEDRIVER_PATH)
     driver = webdriver.Chrome(service=service, options=options)
     return driver
 
+def quit_driver(driver):
+    # The browser may already be gone after a crash
+    try:
+        driver.quit()
+    except Exception as e:
+        print(f"Error closing the browser: {e}")
+
+# A session whose browser crashed fails on every command
+def driver_alive(driver):
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+# Expanded addresses are cached per rule set, so Quebec and the other regions never share entries
+STREET_CACHE = street_normalizer.LRUCache(int(os.getenv('STREET_CACHE_SIZE', '10000')))
+STREET_CACHE_LOCK = threading.Lock()
+
+def _expand_address_abbreviations(address, street_types):
+    return street_normalizer.split_street_type(address, street_types, DIRECTIONS_SET)[0]
+
 def expand_address_abbreviations(address):
-    # Split the address into parts
-    parts = re.split(r'(\s+)', address)
-
-    # Initialize variables
-    comma_index = None
-    direction_index = None
-    target_index = None
-    street_type = None
-    style = 'English'
-
-    # Find the index of the first comma
-    for i, part in enumerate(parts):
-        if ',' in part:
-            comma_index = i
-            break
-
-    # Find the index of the direction (search from back to front)
-    for i in range(len(parts) - 1, -1, -1):
-        if parts[i].strip() in DIRECTIONS:
-            direction_index = i
-            break
-
-    # Determine the starting index for the backward search
-    start_index = comma_index if comma_index is not None else len(parts) - 1    
-        
-    # Determine the index of the word to replace (search from back to front)
-    for i in range(start_index, -1, -1):
-        for abbrev in REPLACEMENTS.keys():
-            if re.search(abbrev, ' ' + parts[i].strip() + ' ', flags=re.IGNORECASE):
-                if target_index is not None:
-                    # If another replacement is found, assume English style
-                    style = 'English'
-                    break
-                target_index = i
-        if target_index is not None:
-            break
-
-    # Detect French style based on the replacement part position
-    if target_index is not None and target_index < start_index and (direction_index is None or target_index != direction_index - 2):
-        style = 'French'
-
-    # Replace the target abbreviation if found
-    if target_index is not None and target_index >= 0:
-        for abbrev, full in REPLACEMENTS.items():
-            if re.search(abbrev, ' ' + parts[target_index] + ' ', flags=re.IGNORECASE):
-                parts[target_index] = re.sub(abbrev, full.strip(), ' ' + parts[target_index] + ' ', flags=re.IGNORECASE).strip()
-                street_type = parts[target_index]                
-                break
-        if street_type is None:
-            target_index = None
+    quebec = STREET_TYPES is QUEBEC_STREET_TYPES
+    # The lookup threads share the cache
+    with STREET_CACHE_LOCK:
+        return STREET_CACHE.get_or_compute((quebec, address), _expand_address_abbreviations, address, STREET_TYPES)
+
+# Per-stage timings of the lookups, configured from the command line in __main__
+TIMERS = run_metrics.StageTimers('ca_postcodes')
+PROFILER = None
+
+# Timeouts of the browser waits, shared by the lookup threads. They start at
+# the 10 s the dropdown used to be given and follow the observed waits.
+PAGE_LOAD_WAITS = waits.LatencyController(initial=10, minimum=3, maximum=30)
+# Longer than waits.EMPTY_SETTLE_SECONDS, or no address would count as without suggestions
+SUGGESTION_WAITS = waits.LatencyController(initial=10, minimum=3, maximum=10)
+
+# Results of earlier runs, opened in __main__ unless --no-cache is given. The
+# lookup threads check it before get_postal_code, which stores the results.
+LOOKUP_CACHE = None
+
+# Returned by get_postal_code instead of a postal code when the lookup got no
+# answer (the suggestions did not show up in time, the page failed): the
+# address is neither cached nor marked invalid, and is looked up again later
+RETRY = object()
 
-    return ''.join(parts)
+# (hit, postal_code) of an expanded address in the lookup cache
+def cached_postal_code(address):
+    if LOOKUP_CACHE is None:
+        return False, None
+    with TIMERS.stage('cache', 1):
+        return LOOKUP_CACHE.get(address, STREET_TYPES is QUEBEC_STREET_TYPES)
+
+def cache_postal_code(address, postal_code):
+    if LOOKUP_CACHE is not None:
+        LOOKUP_CACHE.put(address, STREET_TYPES is QUEBEC_STREET_TYPES, postal_code)
 
 def get_postal_code(driver, address, full_address, street_full_name, city_region):
     target_url = "https://www.canadapost-postescanada.ca/ac/"
 
+    # Expand abbreviations in the address
+    with TIMERS.stage('normalize', 1):
+        address = expand_address_abbreviations(address)
+        full_address = expand_address_abbreviations(full_address)    
+        street_full_name = expand_address_abbreviations(street_full_name)
+
     # Check if the page is already loaded
     if driver.current_url != target_url:
-        driver.get(target_url)
-        time.sleep(3)  # Allow time for the page to load
-        
-    # Expand abbreviations in the address
-    address = expand_address_abbreviations(address)
-    full_address = expand_address_abbreviations(full_address)    
-    street_full_name = expand_address_abbreviations(street_full_name)
-    
-    search_box = driver.find_element(By.CSS_SELECTOR, "#address-search")
-    search_box.clear()
-    driver.execute_script("arguments[0].value = arguments[1];", search_box, address)
-    search_box.send_keys(Keys.SPACE);    
-    time.sleep(0.5)  # Allow time for the dropdown to populate
+        with TIMERS.stage('page_load'):
+            driver.get(target_url)
+            # Until the address widget is set up, typing shows no suggestions
+            waits.wait_until(driver, PAGE_LOAD_WAITS, waits.widget_ready)
     
+    with TIMERS.stage('browser_wait', 1):
+        search_box = driver.find_element(By.CSS_SELECTOR, "#address-search")
+        search_box.clear()
+        # The suggestions of the previous address, which may still be shown
+        seen_titles = waits.mark_suggestions(driver)
+        driver.execute_script("arguments[0].value = arguments[1];", search_box, address)
+        search_box.send_keys(Keys.SPACE);    
+        postal_code = _read_postal_code(driver, address, full_address, street_full_name, city_region, seen_titles)
+    if postal_code is not RETRY:
+        cache_postal_code(address, postal_code)
+    return postal_code
+
+def _read_postal_code(driver, address, full_address, street_full_name, city_region, seen_titles=None):
     try:
-        # Wait until the parent element is present
-        parent_element = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "#top > div.pca > div:nth-child(1) > div.pca.pcalist"))
-        )
+        # Wait until the suggestions of this address are shown
+        try:
+            refreshed = waits.wait_until(driver, SUGGESTION_WAITS, waits.suggestions_refreshed(seen_titles))
+        except TimeoutException:
+            # Nothing shown in time, which does not say the address has no suggestions
+            return RETRY
+        if refreshed == 'empty':
+            # The redrawn list stayed empty for waits.EMPTY_SETTLE_SECONDS
+            return None
+        parent_element = driver.find_element(By.CSS_SELECTOR, waits.SUGGESTIONS_SELECTOR)
 
         # Find all .pcaitem elements within the parent element
         items = parent_element.find_elements(By.CSS_SELECTOR, ".pcaitem")
-        full_address = full_address.strip().lower()
         for item in items:
-            title = item.get_attribute("title").strip().lower()
-            # Check if the title matches the full address and the description starts with the city_region            
-            if full_address in title or title == street_full_name.strip().lower():
+            # Check if the title matches the full address and the description starts with the city_region
+            if address_complete.title_matches(item.get_attribute("title") or '', full_address, street_full_name):
                 description = item.find_element(By.CSS_SELECTOR, ".pcadescription").text
-                if city_region in description:
-                    pattern = f"^.*{re.escape(city_region)}"
-                    description = re.sub(pattern, "", description, flags=re.IGNORECASE).strip()
-                    # Regex pattern to match the postal code format at the end of the string
-                    match = re.search(r"^(\w{3}\s\w{3})\s*", description, flags=re.IGNORECASE)
-                    if match:
-                        postal_code = match.group(0)
-                        return postal_code.strip().upper()
+                postal_code = address_complete.postal_code_from_description(description, city_region)
+                if postal_code:
+                    return postal_code
     except Exception as e:
+        # A crashed browser is not a missing postal code, the caller starts a new one
+        if not driver_alive(driver):
+            raise
         print(f"Error fetching postal code for {address}: {e}")
-        return None
+        return RETRY
 
     return None  # Return None if no postal code is found
 
+REGIONS = [
+    'Alberta', 'British Columbia', 'Manitoba', 'New Brunswick',
+    'Northwest Territories', 'Nova Scotia', 'Ontario',
+    'Prince Edward Island', 'Quebec', 'Saskatchewan',
+    'Newfoundland and Labrador', 'Yukon', 'Nunavut'
+]
+
+def use_street_types_of(region):
+    global STREET_TYPES
+    # Use the Quebec street types for the selected region
+    if region == 'Quebec':
+        STREET_TYPES = QUEBEC_STREET_TYPES
+
 def select_canadian_region():
-    regions = [
-        'Alberta', 'British Columbia', 'Manitoba', 'New Brunswick',
-        'Northwest Territories', 'Nova Scotia', 'Ontario',
-        'Prince Edward Island', 'Quebec', 'Saskatchewan',
-        'Newfoundland and Labrador', 'Yukon', 'Nunavut'
-    ]
+    regions = REGIONS
 
     print("Select a canadian state by entering the corresponding number:")
     for idx, region in enumerate(regions, 1):
@@ -790,37 +854,280 @@ def select_canadian_region():
             choice = int(input("Enter the number of your choice: "))
             if 1 <= choice <= len(regions):
                 selected_region = regions[choice - 1]
-                # Update the REPLACEMENTS object based on the selected region
-                if selected_region == 'Quebec':
-                    for key, new_value in QUEBEC_REPLACEMENTS.items():
-                        if key in REPLACEMENTS:
-                            REPLACEMENTS[key] = new_value
+                use_street_types_of(selected_region)
                 return selected_region
             else:
                 print(f"Please enter a number between 1 and {len(regions)}.")
         except ValueError:
             print("Invalid input. Please enter a number.")
 
+# One lookup thread: its own browser, database connection and queue claims.
+# The browser is replaced after recycle_after lookups, to keep the memory of
+# Chrome in check, and when it crashes; the address is then tried once more.
+def run_lookup_worker(position, selected_region, args, stop, errors):
+    worker = f"{socket.gethostname()}:{os.getpid()}:{position}"
+    cur = get_connection().cursor()
+    driver = None
+    lookups = 0
+    claimed = set()
+    # Lookups of each address that got no answer, in this thread
+    attempts = {}
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            queue_ids = work_queue.claim_addresses(cur, selected_region, worker, args.batch_size, args.stale_minutes)
+            get_connection().commit()
+            claimed.update(queue_ids)
+            addresses = get_claimed_addresses(queue_ids) if queue_ids else []
+            TIMERS.record('fetch', time.perf_counter() - start, len(addresses))
+            if not addresses:
+                break
+
+            retries = []
+            for queue_id, address, street_no, street_full_name, full_address, city_region, city, region in addresses:
+                if stop.is_set():
+                    break
+                print(f"[{position}] Fetching postal code for: {address}")
+                # A cached result needs no browser, and does not count towards recycle_after
+                hit, postal_code = cached_postal_code(expand_address_abbreviations(address))
+                if not hit:
+                    for attempt in range(2):
+                        if driver is None or lookups >= args.recycle_after:
+                            if driver is not None:
+                                quit_driver(driver)
+                            with TIMERS.stage('driver_start'):
+                                driver = create_driver(not args.show_browser)
+                            lookups = 0
+                        try:
+                            with TIMERS.stage('lookup', 1):
+                                postal_code = get_postal_code(driver, address, full_address, street_full_name, city_region)
+                            lookups += 1
+                            break
+                        except WebDriverException as e:
+                            print(f"[{position}] Browser crashed or did not load while fetching {address}: {e}")
+                            TIMERS.record('driver_crash', 0)
+                            quit_driver(driver)
+                            driver = None
+                    else:
+                        # Crashed twice, it goes back to the queue when this worker stops
+                        continue
+                if postal_code is RETRY:
+                    print(f"[{position}] No answer for address: {address}, it will be looked up again")
+                    TIMERS.record('lookup_retry', 0)
+                    attempts[queue_id] = attempts.get(queue_id, 0) + 1
+                    # After the last attempt it goes back to the queue when this worker stops
+                    if attempts[queue_id] < args.max_attempts:
+                        retries.append(queue_id)
+                    continue
+                if postal_code:
+                    print(f"[{position}] Found postal code: {postal_code} for address: {address}")
+                else:
+                    print(f"[{position}] Could not find postal code for address: {address}")
+                with TIMERS.stage('update', 1):
+                    update_postal_code_in_db(street_no, street_full_name, city, region, postal_code, queue_id)
+                claimed.discard(queue_id)
+                TIMERS.maybe_emit()
+                # cProfile follows a single thread
+                if PROFILER is not None and position == 1:
+                    PROFILER.batch_done()
+
+            # Back to the queue for the next claim, with the longer timeouts of
+            # the waits that timed out
+            if retries:
+                work_queue.release_addresses(cur, retries, worker)
+                get_connection().commit()
+                claimed.difference_update(retries)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+        raise
+    finally:
+        # Whatever this worker claimed and did not finish goes back to the queue
+        if claimed:
+            get_connection().rollback()
+            work_queue.release_addresses(cur, claimed, worker)
+            get_connection().commit()
+        cur.close()
+        close_connection()
+        if driver is not None:
+            quit_driver(driver)
+
+# The http backend: the same normalization, then the AddressComplete endpoints
+async def get_postal_code_http(client, address, full_address, street_full_name, city_region):
+    with TIMERS.stage('normalize', 1):
+        address = expand_address_abbreviations(address)
+        full_address = expand_address_abbreviations(full_address)
+        street_full_name = expand_address_abbreviations(street_full_name)
+    hit, postal_code = cached_postal_code(address)
+    if hit:
+        return postal_code
+    postal_code = await client.lookup(address, full_address, street_full_name, city_region)
+    cache_postal_code(address, postal_code)
+    return postal_code
+
+async def _lookup_http(client, row):
+    queue_id, address, street_no, street_full_name, full_address, city_region, city, region = row
+    start = time.perf_counter()
+    try:
+        postal_code = await get_postal_code_http(client, address, full_address, street_full_name, city_region)
+    except address_complete.SERVICE_ERRORS as e:
+        # The service did not answer, which says nothing about the address
+        return row, None, e
+    except address_complete.AddressCompleteError as e:
+        # An error of the key or the account stops the run, see FATAL_ERRORS
+        if e.fatal:
+            raise
+        return row, None, e
+    TIMERS.record('lookup', time.perf_counter() - start, 1)
+    return row, postal_code, None
+
+# Claims batches from the queue like run_lookup_worker, and looks up each
+# batch concurrently; the results are written as they come in. Addresses the
+# service failed on go back to the queue at the end, as do the claimed ones
+# when a fatal AddressCompleteError stops the run.
+async def run_http_lookups(selected_region, args):
+    worker = f"{socket.gethostname()}:{os.getpid()}:http"
+    cur = get_connection().cursor()
+    claimed = set()
+    lookups = []
+    client = address_complete.AddressCompleteClient(ADDRESS_COMPLETE_KEY, args.address_complete_url,
+                                                    args.concurrency, record_path=args.record)
+    async with client:
+        try:
+            while True:
+                start = time.perf_counter()
+                queue_ids = work_queue.claim_addresses(cur, selected_region, worker, args.batch_size, args.stale_minutes)
+                get_connection().commit()
+                claimed.update(queue_ids)
+                addresses = get_claimed_addresses(queue_ids) if queue_ids else []
+                TIMERS.record('fetch', time.perf_counter() - start, len(addresses))
+                if not addresses:
+                    break
+
+                lookups = [asyncio.ensure_future(_lookup_http(client, row)) for row in addresses]
+                for lookup in asyncio.as_completed(lookups):
+                    row, postal_code, error = await lookup
+                    queue_id, address, street_no, street_full_name, full_address, city_region, city, region = row
+                    if error is not None:
+                        print(f"Error fetching postal code for {address}: {error!r}")
+                        TIMERS.record('lookup_error', 0)
+                        continue
+                    if postal_code:
+                        print(f"Found postal code: {postal_code} for address: {address}")
+                    else:
+                        print(f"Could not find postal code for address: {address}")
+                    with TIMERS.stage('update', 1):
+                        update_postal_code_in_db(street_no, street_full_name, city, region, postal_code, queue_id)
+                    claimed.discard(queue_id)
+                    TIMERS.maybe_emit()
+                    if PROFILER is not None:
+                        PROFILER.batch_done()
+        finally:
+            # Lookups still running when a lookup or an update failed
+            for lookup in lookups:
+                lookup.cancel()
+            await asyncio.gather(*lookups, return_exceptions=True)
+            if claimed:
+                get_connection().rollback()
+                work_queue.release_addresses(cur, claimed, worker)
+                get_connection().commit()
+            cur.close()
+    print(f"{client.requests} requests to {client.base_url}")
+
 if __name__ == "__main__":
-    driver = create_driver()
-    limit = 1000
-    offset = 0
+    parser = argparse.ArgumentParser(description="Look up the missing postal codes of mrag_ca_addresses")
+    parser.add_argument('--metrics-log', help="append the per-stage timings as JSON lines to this file")
+    parser.add_argument('--metrics-textfile', help="write the per-stage timings to this Prometheus textfile")
+    parser.add_argument('--metrics-interval', type=int, default=60, help="seconds between two writes of the metrics")
+    parser.add_argument('--profile', help="write a cProfile of a window of lookups of the first browser to this file")
+    parser.add_argument('--profile-skip', type=int, default=10, help="lookups before the profiled window")
+    parser.add_argument('--profile-batches', type=int, default=20, help="lookups in the profiled window")
+    parser.add_argument('--region', choices=REGIONS, help="region to process, asked for when not given")
+    parser.add_argument('--batch-size', type=int, default=50, help="addresses claimed from the queue at a time")
+    parser.add_argument('--stale-minutes', type=int, default=30,
+                        help="take over addresses claimed by a worker this many minutes ago and not done")
+    parser.add_argument('--drivers', type=int, default=int(os.getenv('LOOKUP_DRIVERS', '1')),
+                        help="browsers looking up addresses side by side, each on its own thread")
+    parser.add_argument('--recycle-after', type=int, default=int(os.getenv('DRIVER_RECYCLE_AFTER', '200')),
+                        help="lookups after which a browser is replaced by a fresh one")
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help="lookups of an address without an answer in a browser thread before it leaves it")
+    parser.add_argument('--show-browser', action='store_true', help="run visible browsers instead of headless ones")
+    parser.add_argument('--backend', choices=['browser', 'http'], default='browser',
+                        help="look up with Chrome, or call the AddressComplete endpoints directly")
+    parser.add_argument('--concurrency', type=int, default=8, help="requests in flight at a time with --backend http")
+    parser.add_argument('--address-complete-url', default=os.getenv('ADDRESS_COMPLETE_URL', address_complete.DEFAULT_URL),
+                        help="server of the AddressComplete endpoints, e.g. a recorded_server.py")
+    parser.add_argument('--record', help="save the AddressComplete responses to this file for recorded_server.py")
+    parser.add_argument('--cache', default=os.getenv('LOOKUP_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lookup_cache.sqlite3')),
+                        help="SQLite file with the results of earlier lookups")
+    parser.add_argument('--no-cache', action='store_true', help="look up every address, without reading or writing the cache")
+    parser.add_argument('--found-ttl-days', type=float, default=float(os.getenv('FOUND_TTL_DAYS', '365')),
+                        help="days a cached postal code is used")
+    parser.add_argument('--missing-ttl-days', type=float, default=float(os.getenv('MISSING_TTL_DAYS', '30')),
+                        help="days a cached address without postal code is used")
+    args = parser.parse_args()
+    if args.backend == 'http' and not ADDRESS_COMPLETE_KEY:
+        parser.error("--backend http needs ADDRESS_COMPLETE_KEY in .env")
+
+    if args.region:
+        selected_region = args.region
+        use_street_types_of(selected_region)
+    else:
+        selected_region = select_canadian_region()
+    TIMERS.configure(args.metrics_log, args.metrics_textfile, args.metrics_interval, region=selected_region)
+    if args.profile:
+        PROFILER = run_metrics.BatchProfiler(args.profile, args.profile_skip, args.profile_batches)
+    if not args.no_cache:
+        LOOKUP_CACHE = lookup_cache.LookupCache(args.cache, args.found_ttl_days, args.missing_ttl_days)
 
-    selected_region = select_canadian_region()
+    cur = get_connection().cursor()
+    work_queue.create_queue_table(cur)
+    queued = work_queue.fill_queue(cur, selected_region)
+    get_connection().commit()
+    print(f"Queued {queued} addresses of {selected_region}")
 
-    while True:
-        addresses = get_addresses_from_db(selected_region, limit, offset)
-        if not addresses:
-            break
-
-        for address, street_no, street_full_name, full_address, city_region, city, region in addresses:
-            print(f"Fetching postal code for: {address}")
-            postal_code = get_postal_code(driver, address, full_address, street_full_name, city_region)
-            if postal_code:
-                print(f"Found postal code: {postal_code} for address: {address}")                
-            else:
-                print(f"Could not find postal code for address: {address}")
-            update_postal_code_in_db(street_no, street_full_name, city, region, postal_code)
-        offset += limit
+    stop = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=run_lookup_worker, args=(position, selected_region, args, stop, errors),
+                                name=f"lookup-{position}")
+               for position in range(1, args.drivers + 1)]
+    try:
+        if args.backend == 'http':
+            try:
+                asyncio.run(run_http_lookups(selected_region, args))
+            except address_complete.AddressCompleteError as e:
+                print(f"Stopping: {e}")
+                errors.append(e)
+        else:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # join with a timeout, so Ctrl+C reaches the main thread
+                while thread.is_alive():
+                    thread.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping, the lookups in progress finish first")
+        stop.set()
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+    finally:
+        TIMERS.emit()
+        if PROFILER is not None:
+            PROFILER.close()
 
-    driver.quit()
+    for status, count in work_queue.queue_summary(cur, selected_region):
+        print(f"{status}: {count} addresses")
+    cur.close()
+    print(f"Street cache: {STREET_CACHE.stats()}")
+    if LOOKUP_CACHE is not None:
+        print(f"Lookup cache: {LOOKUP_CACHE.stats()}")
+        LOOKUP_CACHE.close()
+    if args.backend == 'browser':
+        print(f"Page load waits: {PAGE_LOAD_WAITS.describe()}")
+        print(f"Suggestion waits: {SUGGESTION_WAITS.describe()}")
+    for line in TIMERS.report():
+        print(line)
+    if errors:
+        sys.exit(1)
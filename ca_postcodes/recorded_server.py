@@ -0,0 +1,57 @@
+# Local stand-in for the AddressComplete endpoints that replays the responses
+# recorded with `python main.py --backend http --record <file>`, so the http
+# backend can be run and timed without Canada Post:
+#
+#   python recorded_server.py recordings.json --port 8765
+#   python main.py --backend http --address-complete-url http://127.0.0.1:8765 ...
+
+import sys
+import json
+import time
+import argparse
+from urllib.parse import urlsplit, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from address_complete import recording_key
+
+def make_handler(recordings, delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real service
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            key = recording_key(url.path, dict(parse_qsl(url.query)))
+            data = recordings.get(key)
+            if data is None:
+                print(f"Not recorded: {key}", file=sys.stderr)
+                data = {'Items': []}
+            if delay:
+                time.sleep(delay)
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded AddressComplete responses")
+    parser.add_argument('recordings', help="file written by main.py --record")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds to wait before every response")
+    args = parser.parse_args()
+
+    with open(args.recordings, encoding='utf-8') as file:
+        recordings = json.load(file)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(recordings, args.delay))
+    print(f"Replaying {len(recordings)} responses on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,69 @@
+# Checks AddressCompleteClient.lookup against recorded_server.py replaying
+# test_recordings.json, a small hand-made recording of found, not found,
+# retrieved, container and error responses. Needs aiohttp, not Canada Post:
+#
+#   python -m unittest test_address_complete
+
+import os
+import json
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+from address_complete import AddressCompleteClient, AddressCompleteError
+from recorded_server import make_handler
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_recordings.json')
+
+class LookupTest(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(RECORDINGS_PATH, encoding='utf-8') as file:
+            recordings = json.load(file)
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(recordings, 0))
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    async def lookup(self, address, full_address, street_full_name, city_region):
+        async with AddressCompleteClient('test-key', self.url) as client:
+            postal_code = await client.lookup(address, full_address, street_full_name, city_region)
+        return postal_code, client.requests
+
+    async def test_found(self):
+        self.assertEqual(await self.lookup('100 Main Street Toronto, ON', '100 Main Street', 'Main Street',
+                                           'Toronto, ON, '), ('M4E 2V6', 1))
+
+    async def test_retrieved(self):
+        self.assertEqual(await self.lookup('5 Birch Road Sudbury, ON', '5 Birch Road', 'Birch Road',
+                                           'Sudbury, ON, '), ('P3A 1B2', 2))
+
+    async def test_not_found(self):
+        # Other city, and a title that only contains the street name
+        self.assertEqual(await self.lookup('7 Nowhere Lane Toronto, ON', '7 Nowhere Lane', 'Nowhere Lane',
+                                           'Toronto, ON, '), (None, 1))
+        self.assertEqual(await self.lookup('9 Empty Street Toronto, ON', '9 Empty Street', 'Empty Street',
+                                           'Toronto, ON, '), (None, 1))
+
+    async def test_container(self):
+        self.assertEqual(await self.lookup('200 King Street West Toronto, ON', '200 King Street West',
+                                           'King Street West', 'Toronto, ON, '), ('M5H 3T4', 2))
+
+    async def test_error_item(self):
+        with self.assertRaises(AddressCompleteError) as raised:
+            await self.lookup('1 Bad Search', '1 Bad Search', 'Bad Search', 'Toronto, ON, ')
+        self.assertEqual(raised.exception.number, 1001)
+        self.assertFalse(raised.exception.fatal)
+
+        with self.assertRaises(AddressCompleteError) as raised:
+            await self.lookup('1 Over Limit', '1 Over Limit', 'Over Limit', 'Toronto, ON, ')
+        self.assertEqual(raised.exception.number, 3)
+        self.assertTrue(raised.exception.fatal)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+# Waits of the browser lookups. Instead of fixed sleeps, get_postal_code polls
+# for the condition it needs (the page and its address widget are ready, the
+# suggestions of the typed address are shown) with a timeout that a
+# LatencyController derives from the recent wait times.
+
+import time
+import threading
+from collections import deque
+
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
+
+# How often a condition is checked; the default of WebDriverWait is 0.5 s
+POLL_SECONDS = 0.05
+
+SUGGESTIONS_SELECTOR = "#top > div.pca > div:nth-child(1) > div.pca.pcalist"
+
+# How long the redrawn list has to stay empty before the address counts as
+# without suggestions. The widget also empties the list while the suggestions
+# are still on their way, e.g. on the input events of clearing the box or
+# before the debounce of typing; the timeout of the suggestion waits has to be
+# longer than this.
+EMPTY_SETTLE_SECONDS = 2.0
+
+# Marks the suggestions shown now and returns their titles, before a new
+# address is typed; null when there is no list yet. The hidden sentinel is gone
+# once the widget redraws the list, which tells an empty list of suggestions
+# from one that was not updated yet.
+MARK_SUGGESTIONS = """
+    var list = document.querySelector(arguments[0]);
+    if (!list) return null;
+    if (!list.querySelector('[data-mrag-sentinel]')) {
+        var sentinel = document.createElement('div');
+        sentinel.setAttribute('data-mrag-sentinel', '1');
+        sentinel.style.display = 'none';
+        list.appendChild(sentinel);
+    }
+    var items = list.querySelectorAll('.pcaitem');
+    var titles = [];
+    for (var i = 0; i < items.length; i++) {
+        items[i].setAttribute('data-mrag-seen', '1');
+        titles.push(items[i].getAttribute('title'));
+    }
+    return titles.join('\\n');
+"""
+
+# 'items' once an item is not marked or the titles changed, 'empty' while the
+# widget shows the list it redrew without suggestions (only known when it was
+# marked)
+SUGGESTIONS_REFRESHED = """
+    var list = document.querySelector(arguments[0]);
+    if (!list) return false;
+    var items = list.querySelectorAll('.pcaitem');
+    if (!items.length) return arguments[2] && !list.querySelector('[data-mrag-sentinel]') ? 'empty' : false;
+    var titles = [];
+    var fresh = false;
+    for (var i = 0; i < items.length; i++) {
+        fresh = fresh || !items[i].hasAttribute('data-mrag-seen');
+        titles.push(items[i].getAttribute('title'));
+    }
+    return fresh || titles.join('\\n') !== arguments[1] ? 'items' : false;
+"""
+
+# The address widget adds its container to #top once it is set up
+WIDGET_READY = """
+    return document.readyState === 'complete'
+        && document.querySelector('#address-search') !== null
+        && document.querySelector('#top > div.pca') !== null;
+"""
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+class LatencyController:
+    """Timeout of a wait, from the durations of the recent waits.
+
+    Until ``min_samples`` waits were observed the timeout is ``initial``; then
+    it is ``factor`` times the ``quantile`` of the last ``window`` waits, kept
+    between ``minimum`` and ``maximum``. A wait that times out is observed with
+    the timeout it waited, a lower bound of its duration; after
+    ``backoff_after`` timeouts in a row every further one multiplies the
+    timeout by ``factor`` (up to ``maximum``) until a wait succeeds, so a site
+    that slowed down is not given up on at the old timeout.
+    """
+
+    def __init__(self, initial, minimum, maximum, quantile=0.99, factor=2.0, window=200, min_samples=20,
+                 backoff_after=3):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quantile = quantile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.backoff_after = backoff_after
+        self.samples = deque(maxlen=window)
+        self.timeouts = 0
+        self.timeouts_in_a_row = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.timeouts_in_a_row = 0
+
+    def timed_out(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.timeouts += 1
+            self.timeouts_in_a_row += 1
+
+    def timeout(self):
+        with self.lock:
+            backoff = self.factor ** max(self.timeouts_in_a_row - self.backoff_after + 1, 0)
+            if len(self.samples) < self.min_samples:
+                return min(self.initial * backoff, self.maximum)
+            recent = sorted(self.samples)
+        return min(max(_percentile(recent, self.quantile) * self.factor, self.minimum) * backoff, self.maximum)
+
+    def describe(self):
+        with self.lock:
+            recent = sorted(self.samples)
+            timeouts = self.timeouts
+        if not recent:
+            return f"timeout {self.timeout():.2f}s, no waits observed, {timeouts} timed out"
+        return (f"timeout {self.timeout():.2f}s, p50 {_percentile(recent, 0.50):.2f}s, "
+                f"p99 {_percentile(recent, 0.99):.2f}s of the last {len(recent)} waits, {timeouts} timed out")
+
+# Wait until condition(driver) is true, with the timeout of the controller.
+# Returns the value of the condition; TimeoutException when it never became true.
+def wait_until(driver, controller, condition):
+    start = time.perf_counter()
+    try:
+        result = WebDriverWait(driver, controller.timeout(), POLL_SECONDS).until(condition)
+    except TimeoutException:
+        controller.timed_out(time.perf_counter() - start)
+        raise
+    controller.observe(time.perf_counter() - start)
+    return result
+
+def widget_ready(driver):
+    return driver.execute_script(WIDGET_READY)
+
+def mark_suggestions(driver):
+    return driver.execute_script(MARK_SUGGESTIONS, SUGGESTIONS_SELECTOR)
+
+# seen_titles is what mark_suggestions returned. 'items', or 'empty' once the
+# list stayed empty for settle seconds in a row.
+def suggestions_refreshed(seen_titles, settle=EMPTY_SETTLE_SECONDS):
+    empty_since = None
+
+    def condition(driver):
+        nonlocal empty_since
+        refreshed = driver.execute_script(SUGGESTIONS_REFRESHED, SUGGESTIONS_SELECTOR, seen_titles or '',
+                                          seen_titles is not None)
+        if refreshed != 'empty':
+            empty_since = None
+            return refreshed
+        if empty_since is None:
+            empty_since = time.perf_counter()
+        return refreshed if time.perf_counter() - empty_since >= settle else False
+    return condition
@@ -0,0 +1,88 @@
+# Work queue of the distinct addresses that still need a postal code. A region
+# is queued once from mrag_ca_addresses; any number of scraper processes, on
+# any number of hosts, claim batches with FOR UPDATE SKIP LOCKED and mark every
+# address done in the transaction that writes its postal code.
+
+def create_queue_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mrag_postal_code_queue (
+            id bigserial PRIMARY KEY,
+            region varchar(255) NOT NULL,
+            street_no varchar(30) NULL,
+            street_full_name varchar(100) NOT NULL,
+            city varchar(255) NULL,
+            status varchar(10) DEFAULT 'pending' NOT NULL,
+            worker varchar(255) NULL,
+            claimed_at timestamptz NULL,
+            finished_at timestamptz NULL,
+            postal_code varchar(20) NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS mrag_postal_code_queue_idx_by_address
+        ON mrag_postal_code_queue (region, coalesce(street_no, ''), street_full_name, coalesce(city, ''))
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS mrag_postal_code_queue_idx_by_region_status
+        ON mrag_postal_code_queue (region, status)
+    """)
+
+# Queue the addresses of the region without a postal code. An address that is
+# already done is queued again when new rows without a postal code showed up
+# for it. Returns the number of queued addresses.
+def fill_queue(cursor, region):
+    cursor.execute("""
+        INSERT INTO mrag_postal_code_queue (region, street_no, street_full_name, city)
+        SELECT DISTINCT region, street_no, street_full_name, city
+        FROM public.mrag_ca_addresses
+        WHERE postal_code IS NULL AND is_valid = true AND region = %s
+        ON CONFLICT (region, coalesce(street_no, ''), street_full_name, coalesce(city, '')) DO UPDATE
+        SET status = 'pending', worker = NULL, claimed_at = NULL, finished_at = NULL, postal_code = NULL
+        WHERE mrag_postal_code_queue.status = 'done'
+    """, (region,))
+    return cursor.rowcount
+
+# Claim up to `limit` pending addresses of the region, or running ones whose
+# worker claimed them more than stale_minutes ago. Returns their ids.
+def claim_addresses(cursor, region, worker, limit, stale_minutes):
+    cursor.execute("""
+        UPDATE mrag_postal_code_queue
+        SET status = 'running', worker = %s, claimed_at = now()
+        WHERE id IN (
+            SELECT id
+            FROM mrag_postal_code_queue
+            WHERE region = %s
+            AND (status = 'pending' OR (status = 'running' AND claimed_at < now() - %s * interval '1 minute'))
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT %s
+        )
+        RETURNING id
+    """, (worker, region, stale_minutes, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+# Called in the transaction that updates mrag_ca_addresses
+def finish_address(cursor, queue_id, postal_code):
+    cursor.execute("""
+        UPDATE mrag_postal_code_queue
+        SET status = 'done', finished_at = now(), postal_code = %s
+        WHERE id = %s
+    """, (postal_code, queue_id))
+
+# Give claimed but unprocessed addresses back, e.g. when the scraper stops
+def release_addresses(cursor, queue_ids, worker):
+    cursor.execute("""
+        UPDATE mrag_postal_code_queue
+        SET status = 'pending', worker = NULL, claimed_at = NULL
+        WHERE id = ANY(%s) AND status = 'running' AND worker = %s
+    """, (list(queue_ids), worker))
+
+def queue_summary(cursor, region):
+    cursor.execute("""
+        SELECT status, count(*)
+        FROM mrag_postal_code_queue
+        WHERE region = %s
+        GROUP BY status
+        ORDER BY status
+    """, (region,))
+    return cursor.fetchall()
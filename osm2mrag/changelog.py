@@ -0,0 +1,100 @@
+# Changelog of planet_osm_polygon for incremental runs after osm2pgsql-replication.
+# A trigger records the osm_id of every inserted, updated or deleted polygon that
+# has (or had) address tags; `sync` re-processes only those ids.
+
+def install_changelog(cursor, address_filter):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mrag_osm_polygon_changes (
+            id bigserial PRIMARY KEY,
+            osm_id bigint NOT NULL,
+            operation char(1) NOT NULL,
+            changed_at timestamptz DEFAULT now() NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS mrag_osm_polygon_changes_idx_by_osm_id
+        ON mrag_osm_polygon_changes (osm_id)
+    """)
+    new_filter = address_filter.replace("tags", "NEW.tags")
+    old_filter = address_filter.replace("tags", "OLD.tags")
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION mrag_function_log_polygon_change () RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                IF {old_filter} THEN
+                    INSERT INTO mrag_osm_polygon_changes (osm_id, operation) VALUES (OLD.osm_id, 'D');
+                END IF;
+                RETURN OLD;
+            END IF;
+
+            IF {new_filter} OR (TG_OP = 'UPDATE' AND {old_filter}) THEN
+                INSERT INTO mrag_osm_polygon_changes (osm_id, operation) VALUES (NEW.osm_id, left(TG_OP, 1));
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS planet_osm_polygon_tr_log_change ON planet_osm_polygon")
+    cursor.execute("""
+        CREATE TRIGGER planet_osm_polygon_tr_log_change AFTER INSERT
+        OR UPDATE OR DELETE ON
+        planet_osm_polygon FOR EACH ROW EXECUTE FUNCTION mrag_function_log_polygon_change()
+    """)
+
+# Changes recorded after this id are left for the next sync
+def last_change_id(cursor):
+    cursor.execute("SELECT max(id) AS id FROM mrag_osm_polygon_changes")
+    return cursor.fetchone()['id']
+
+def count_changed_ids(cursor, max_change_id):
+    cursor.execute("""
+        SELECT count(DISTINCT osm_id) AS count
+        FROM mrag_osm_polygon_changes
+        WHERE id <= %s
+    """, (max_change_id,))
+    return cursor.fetchone()['count']
+
+def get_changed_ids(cursor, limit, max_change_id, last_osm_id=None):
+    if last_osm_id is None:
+        cursor.execute("""
+            SELECT DISTINCT osm_id
+            FROM mrag_osm_polygon_changes
+            WHERE id <= %s
+            ORDER BY osm_id
+            LIMIT %s
+        """, (max_change_id, limit))
+    else:
+        cursor.execute("""
+            SELECT DISTINCT osm_id
+            FROM mrag_osm_polygon_changes
+            WHERE id <= %s AND osm_id > %s
+            ORDER BY osm_id
+            LIMIT %s
+        """, (max_change_id, last_osm_id, limit))
+    return [row['osm_id'] for row in cursor.fetchall()]
+
+def get_addresses_by_ids(cursor, osm_ids, query):
+    cursor.execute(query + """
+        AND osm_id = ANY(%s)
+        ORDER BY osm_id
+    """, (osm_ids,))
+    return cursor.fetchall()
+
+# Delete the addresses whose polygon is gone or has lost its address tags
+def delete_vanished_addresses(cursor, osm_ids, address_filter):
+    cursor.execute(f"""
+        DELETE FROM mrag_ca_addresses a
+        WHERE a.id = ANY(%s)
+        AND NOT EXISTS (
+            SELECT 1
+            FROM planet_osm_polygon
+            WHERE osm_id = a.id::bigint AND {address_filter}
+        )
+    """, ([str(osm_id) for osm_id in osm_ids],))
+    return cursor.rowcount
+
+def clear_changes(cursor, osm_ids, max_change_id):
+    cursor.execute("""
+        DELETE FROM mrag_osm_polygon_changes
+        WHERE osm_id = ANY(%s) AND id <= %s
+    """, (osm_ids, max_change_id))
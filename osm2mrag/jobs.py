@@ -0,0 +1,151 @@
+# Job table used to split one import over several processes or machines.
+# A run is planned once into osm_id ranges; workers claim ranges with
+# FOR UPDATE SKIP LOCKED, each on its own connection, and mark them done.
+
+def create_job_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mrag_import_jobs (
+            id serial PRIMARY KEY,
+            run_name varchar(100) NOT NULL,
+            after_osm_id bigint NULL,
+            last_osm_id bigint NOT NULL,
+            planned_rows int NOT NULL,
+            status varchar(10) DEFAULT 'pending' NOT NULL,
+            worker varchar(255) NULL,
+            claimed_at timestamptz NULL,
+            heartbeat_at timestamptz NULL,
+            finished_at timestamptz NULL,
+            rows_done int DEFAULT 0 NOT NULL,
+            checkpoint_osm_id bigint NULL,
+            attempts int DEFAULT 0 NOT NULL,
+            error text NULL
+        )
+    """)
+    cursor.execute("ALTER TABLE mrag_import_jobs ADD COLUMN IF NOT EXISTS checkpoint_osm_id bigint NULL")
+    cursor.execute("ALTER TABLE mrag_import_jobs ADD COLUMN IF NOT EXISTS attempts int DEFAULT 0 NOT NULL")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS mrag_import_jobs_idx_by_run_status
+        ON mrag_import_jobs (run_name, status)
+    """)
+
+# Split the rows matching address_filter into `jobs` ranges of about the same
+# number of rows. A range covers after_osm_id < osm_id <= last_osm_id, so rows
+# sharing an osm_id always end up in the same job. Returns the number of jobs.
+def plan_jobs(cursor, run_name, jobs, address_filter):
+    cursor.execute("SELECT count(*) AS count FROM mrag_import_jobs WHERE run_name = %s", (run_name,))
+    if cursor.fetchone()['count']:
+        raise Exception(f"Run '{run_name}' is already planned, choose another --run or delete its jobs")
+
+    cursor.execute(f"""
+        SELECT max(osm_id) AS last_osm_id, count(*) AS planned_rows
+        FROM (
+            SELECT osm_id, ntile(%s) OVER (ORDER BY osm_id) AS bucket
+            FROM planet_osm_polygon
+            WHERE {address_filter}
+        ) buckets
+        GROUP BY bucket
+        ORDER BY bucket
+    """, (jobs,))
+
+    after_osm_id = None
+    planned = 0
+    for bucket in cursor.fetchall():
+        # A bucket that ends on the same osm_id as the previous one is already covered by it
+        if after_osm_id is not None and bucket['last_osm_id'] <= after_osm_id:
+            continue
+        cursor.execute("""
+            INSERT INTO mrag_import_jobs (run_name, after_osm_id, last_osm_id, planned_rows)
+            VALUES (%s, %s, %s, %s)
+        """, (run_name, after_osm_id, bucket['last_osm_id'], bucket['planned_rows']))
+        after_osm_id = bucket['last_osm_id']
+        planned += 1
+    return planned
+
+# Claim the next pending job of the run, a running one whose worker has not
+# sent a heartbeat for stale_minutes, or a failed one that was claimed fewer
+# than max_attempts times, e.g. after a dropped connection or a deadlock. A
+# taken over or retried job continues after its checkpoint_osm_id. Returns the
+# job row or None when done.
+def claim_job(cursor, run_name, worker, stale_minutes, max_attempts=3):
+    cursor.execute("""
+        UPDATE mrag_import_jobs
+        SET status = 'running', worker = %s, claimed_at = now(), heartbeat_at = now(), attempts = attempts + 1
+        WHERE id = (
+            SELECT id
+            FROM mrag_import_jobs
+            WHERE run_name = %s
+            AND (status = 'pending'
+                 OR (status = 'running' AND heartbeat_at < now() - %s * interval '1 minute')
+                 OR (status = 'failed' AND attempts < %s))
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, after_osm_id, last_osm_id, planned_rows, checkpoint_osm_id, attempts
+    """, (worker, run_name, stale_minutes, max_attempts))
+    return cursor.fetchone()
+
+# Called in the transaction of every committed batch of the job
+def heartbeat_job(cursor, job_id, rows, last_osm_id):
+    cursor.execute("""
+        UPDATE mrag_import_jobs
+        SET heartbeat_at = now(), rows_done = rows_done + %s, checkpoint_osm_id = %s
+        WHERE id = %s
+    """, (rows, last_osm_id, job_id))
+
+def finish_job(cursor, job_id):
+    cursor.execute("""
+        UPDATE mrag_import_jobs
+        SET status = 'done', finished_at = now(), error = NULL
+        WHERE id = %s
+    """, (job_id,))
+
+def fail_job(cursor, job_id, error):
+    cursor.execute("""
+        UPDATE mrag_import_jobs
+        SET status = 'failed', error = %s
+        WHERE id = %s
+    """, (str(error), job_id))
+
+def job_summary(cursor, run_name):
+    cursor.execute("""
+        SELECT status, count(*) AS jobs, sum(rows_done) AS rows_done
+        FROM mrag_import_jobs
+        WHERE run_name = %s
+        GROUP BY status
+        ORDER BY status
+    """, (run_name,))
+    return cursor.fetchall()
+
+# Checkpoints of single process imports. The last committed osm_id of a run is
+# saved in the transaction of every batch, so --resume continues right after it.
+def create_checkpoint_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mrag_import_checkpoints (
+            run_name varchar(100) PRIMARY KEY,
+            last_osm_id bigint NULL,
+            rows_done bigint DEFAULT 0 NOT NULL,
+            updated_at timestamptz DEFAULT now() NOT NULL
+        )
+    """)
+
+def load_checkpoint(cursor, run_name):
+    cursor.execute("""
+        SELECT last_osm_id, rows_done, updated_at
+        FROM mrag_import_checkpoints
+        WHERE run_name = %s
+    """, (run_name,))
+    return cursor.fetchone()
+
+def save_checkpoint(cursor, run_name, last_osm_id, rows):
+    cursor.execute("""
+        INSERT INTO mrag_import_checkpoints (run_name, last_osm_id, rows_done, updated_at)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (run_name) DO UPDATE SET
+            last_osm_id = EXCLUDED.last_osm_id,
+            rows_done = mrag_import_checkpoints.rows_done + EXCLUDED.rows_done,
+            updated_at = EXCLUDED.updated_at
+    """, (run_name, last_osm_id, rows))
+
+def reset_checkpoint(cursor, run_name):
+    cursor.execute("DELETE FROM mrag_import_checkpoints WHERE run_name = %s", (run_name,))
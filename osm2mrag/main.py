@@ -1,13 +1,33 @@
+import io
 import os
 import re
+import json
+import hashlib
+import argparse
+import multiprocessing
+import socket
+from collections import deque
+import sys
 import Levenshtein
 from tqdm import tqdm
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json
 from shapely.wkt import loads as load_wkt
-from shapely.geometry import Polygon
+from shapely.wkb import loads as load_wkb
+from shapely.geometry import Polygon, Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from dotenv import load_dotenv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared_python'))
+import street_normalizer
+import run_metrics
+import jobs
+import changelog
+import preflight
+import parquet_io
+import sinks
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -489,13 +509,13 @@ DIRECTIONS_REPLACEMENTS = {
         r'\bwst\b$': 'W',
     }
 
-def convert_direction(address):
-    for pattern, replacement in DIRECTIONS_REPLACEMENTS.items():
-        if re.search(pattern, address, re.IGNORECASE):
-            address = re.sub(pattern, replacement, address, flags=re.IGNORECASE)
-            break
+# Compiled once; see shared_python/street_normalizer.py
+STREET_TYPES = street_normalizer.StreetTypeTable(REPLACEMENTS)
+COMPILED_DIRECTIONS = street_normalizer.compile_directions(DIRECTIONS_REPLACEMENTS)
+DIRECTIONS_SET = frozenset(DIRECTIONS)
 
-    return address
+def convert_direction(address):
+    return street_normalizer.convert_direction(address, COMPILED_DIRECTIONS)
 
 def format_postal_code(postal_code):
     if postal_code is not None:
@@ -512,69 +532,19 @@ def format_postal_code(postal_code):
         return formatted_postal_code
     return None
 
-def exchange_address_abbreviations(address):
-    address = convert_direction(address)
-    
-    # Split the address into parts
-    parts = re.split(r'(\s+)', address)
-    
-    # Initialize variables
-    comma_index = None
-    direction_index = None
-    target_index = None
-    street_type = None
-    style = 'English'
-
-    # Find the index of the first comma
-    for i, part in enumerate(parts):
-        if ',' in part:
-            comma_index = i
-            break 
-
-    # Find the index of the direction (search from back to front)
-    for i in range(len(parts) - 1, -1, -1):
-        if parts[i].strip() in DIRECTIONS:
-            direction_index = i
-            break
-        
-    # Determine the starting index for the backward search
-    start_index = comma_index if comma_index is not None else len(parts) - 1    
-        
-    # Determine the index of the word to replace (search from back to front)
-    for i in range(start_index, -1, -1):
-        for abbrev in REPLACEMENTS.keys():
-            if re.search(abbrev, ' ' + parts[i].strip() + ' '):
-                if target_index is not None:
-                    # If another replacement is found, assume English style
-                    style = 'English'
-                    break
-                target_index = i
-        if target_index is not None:
-            break
-
-    # Detect French style based on the replacement part position
-    if target_index is not None and target_index < start_index and (direction_index is None or target_index != direction_index - 2):
-        style = 'French'
+# Street names repeat a lot, so the normalized results are cached (see --street-cache-size)
+STREET_CACHE = street_normalizer.LRUCache(100000)
 
-    # Replace the target abbreviation if found
-    if target_index is not None and target_index >= 0:
-        for abbrev, full in REPLACEMENTS.items():
-            if re.search(abbrev, ' ' + parts[target_index] + ' '):
-                parts[target_index] = re.sub(abbrev, full.strip(), ' ' + parts[target_index] + ' ').strip()
-                street_type = parts[target_index]                
-                break
-        if street_type is None:
-            target_index = None
+def set_street_cache_size(size):
+    STREET_CACHE.resize(size)
+    HOUSE_NO_CACHE.resize(size)
 
-    # Prepare the final updated address
-    updated_address = ''.join(parts)
-    street_quad = parts[direction_index] if direction_index is not None else None
-
-    # Extract the street name excluding replaced_part and direction_part
-    street_name_parts = [part for i, part in enumerate(parts) if i != target_index and i != direction_index]
-    street_name = ''.join(street_name_parts).strip()
+def _exchange_address_abbreviations(address):
+    address = convert_direction(address)
+    return street_normalizer.split_street_type(address, STREET_TYPES, DIRECTIONS_SET)
 
-    return updated_address, street_name, street_type, street_quad
+def exchange_address_abbreviations(address):
+    return STREET_CACHE.get_or_compute(address, _exchange_address_abbreviations, address)
 
 # Function to calculate the centroid of a polygon
 def calculate_centroid(polygon_wkt):
@@ -582,67 +552,310 @@ def calculate_centroid(polygon_wkt):
     centroid = polygon.centroid
     return centroid.x, centroid.y
 
-def get_addresses_from_db(cursor, limit, offset):
+ADDRESS_FILTER = "tags ? 'addr:street' AND tags ? 'addr:postcode' AND tags ? 'addr:housenumber'"
+
+ADDRESS_QUERY_WITHOUT_GEOMETRY = f"""
+    SELECT
+        osm_id,
+        tags->'addr:street' AS street,
+        tags->'addr:postcode' AS postcode,
+        tags->'addr:housenumber' AS housenumber,
+        tags->'addr:state' AS state,
+        tags->'addr:province' AS province,
+        tags->'addr:city' AS city,
+        ST_X(ST_Centroid(way)) AS longitude,
+        ST_Y(ST_Centroid(way)) AS latitude
+    FROM
+        planet_osm_polygon
+    WHERE
+        {ADDRESS_FILTER}
+"""
+
+# Same rows with the polygon itself, which is sent back as the boundary column
+ADDRESS_QUERY = ADDRESS_QUERY_WITHOUT_GEOMETRY.replace("AS latitude\n", "AS latitude,\n        way\n")
+
+# The extract keeps the polygon as EWKB bytes, see parquet_io
+EXTRACT_QUERY = ADDRESS_QUERY_WITHOUT_GEOMETRY.replace("AS latitude\n", "AS latitude,\n        ST_AsEWKB(way) AS way\n")
+
+def get_addresses_from_db(cursor, limit, offset, query=ADDRESS_QUERY):
     # Fetch data from planet_osm_polygon
-    cursor.execute("""
-        SELECT
-            osm_id,
-            tags->'addr:street' AS street,
-            tags->'addr:postcode' AS postcode,
-            tags->'addr:housenumber' AS housenumber,
-            tags->'addr:state' AS state,
-            tags->'addr:province' AS province,
-            tags->'addr:city' AS city,
-            ST_X(ST_Centroid(way)) AS longitude,
-            ST_Y(ST_Centroid(way)) AS latitude,
-            way
-        FROM
-            planet_osm_polygon
-        WHERE
-            tags ? 'addr:street' AND tags ? 'addr:postcode' AND tags ? 'addr:housenumber'
-        LIMIT %s OFFSET %s           
+    cursor.execute(query + """
+        LIMIT %s OFFSET %s
     """, (limit, offset))
     return cursor.fetchall()
 
-# Insert addresses into mrag_ca_addresses table
-def insert_addresses(cursor, addresses):
-    insert_query = """
-        INSERT INTO mrag_ca_addresses (id, street_full_name, street_name, street_type, street_quad, full_address, postal_code, geo_latitude, geo_longitude, boundary, region, city, street_no, house_number, house_alpha, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (id) DO UPDATE SET
-            street_full_name = EXCLUDED.street_full_name,
-            street_name = EXCLUDED.street_name,
-            street_type = EXCLUDED.street_type,
-            street_quad = EXCLUDED.street_quad,
-            full_address = EXCLUDED.full_address,
-            postal_code = EXCLUDED.postal_code,
-            street_no = EXCLUDED.street_no,
-            house_number = EXCLUDED.house_number, 
-            house_alpha = EXCLUDED.house_alpha,
-            unit = EXCLUDED.unit,
-            geo_latitude = EXCLUDED.geo_latitude,
-            geo_longitude = EXCLUDED.geo_longitude,
-            boundary = EXCLUDED.boundary,
-            region = EXCLUDED.region,
-            city = EXCLUDED.city;
+def get_addresses_after(cursor, limit, last_osm_id=None, query=ADDRESS_QUERY, until_osm_id=None):
+    # Keyset pagination: every page is an index range scan starting right after
+    # the last osm_id seen, so page latency does not grow with the position.
+    # Multipolygon parts sharing an osm_id map to the same mrag_ca_addresses id.
+    conditions = ""
+    params = []
+    if last_osm_id is not None:
+        conditions += " AND osm_id > %s"
+        params.append(last_osm_id)
+    if until_osm_id is not None:
+        conditions += " AND osm_id <= %s"
+        params.append(until_osm_id)
+    cursor.execute(query + conditions + """
+        ORDER BY osm_id
+        LIMIT %s
+    """, params + [limit])
+    return cursor.fetchall()
+
+def iter_address_pages(cursor, limit, scan, query=ADDRESS_QUERY, after_osm_id=None, until_osm_id=None):
+    # Re-query planet_osm_polygon for every page, see get_addresses_after.
+    # The osm_id bounds only apply to keyset pages.
+    offset = 0
+    last_osm_id = after_osm_id
+    while True:
+        if scan == 'keyset':
+            rows = get_addresses_after(cursor, limit, last_osm_id, query, until_osm_id)
+        else:
+            rows = get_addresses_from_db(cursor, limit, offset, query)
+        if not rows:
+            break
+        yield rows
+        offset += limit
+        last_osm_id = rows[-1]['osm_id']
+
+def stream_addresses(read_conn, limit, itersize, query=ADDRESS_QUERY, after_osm_id=None):
+    # One server-side (named) cursor over the whole extract. It lives in its own
+    # read-only transaction on read_conn, so commits of the output batches on
+    # the writing connection do not close it.
+    with read_conn.cursor(name='osm2mrag_addresses', cursor_factory=RealDictCursor) as cursor:
+        cursor.itersize = itersize
+        if after_osm_id is None:
+            cursor.execute(query + """
+                ORDER BY osm_id
+            """)
+        else:
+            cursor.execute(query + """
+                AND osm_id > %s
+                ORDER BY osm_id
+            """, (after_osm_id,))
+        rows = []
+        for row in cursor:
+            rows.append(row)
+            if len(rows) >= limit:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+def count_addresses(cursor):
+    cursor.execute(f"SELECT COUNT(*) FROM planet_osm_polygon WHERE {ADDRESS_FILTER}")
+    return cursor.fetchone()['count']
+
+def estimate_addresses(cursor):
+    # Planner row estimate, avoids a full scan just to size the progress bar
+    cursor.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM planet_osm_polygon WHERE {ADDRESS_FILTER}")
+    plan = cursor.fetchone()['QUERY PLAN']
+    return int(plan[0]['Plan']['Plan Rows'])
+
+# Columns of mrag_ca_addresses, in the order of the address tuples built in __main__
+ADDRESS_COLUMNS = ['id', 'street_full_name', 'street_name', 'street_type', 'street_quad', 'full_address', 'postal_code', 'geo_latitude', 'geo_longitude', 'boundary', 'region', 'city', 'street_no', 'house_number', 'house_alpha', 'unit']
+
+UPSERT_SET = """
+    street_full_name = EXCLUDED.street_full_name,
+    street_name = EXCLUDED.street_name,
+    street_type = EXCLUDED.street_type,
+    street_quad = EXCLUDED.street_quad,
+    full_address = EXCLUDED.full_address,
+    postal_code = EXCLUDED.postal_code,
+    street_no = EXCLUDED.street_no,
+    house_number = EXCLUDED.house_number, 
+    house_alpha = EXCLUDED.house_alpha,
+    unit = EXCLUDED.unit,
+    geo_latitude = EXCLUDED.geo_latitude,
+    geo_longitude = EXCLUDED.geo_longitude,
+    boundary = EXCLUDED.boundary,
+    region = EXCLUDED.region,
+    city = EXCLUDED.city,
+    content_hash = EXCLUDED.content_hash
+WHERE mrag_ca_addresses.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+"""
+
+# Columns written to mrag_ca_addresses: the address tuple plus its content hash
+WRITE_COLUMNS = ADDRESS_COLUMNS + ['content_hash']
+
+# Rows of an unchanged address keep their hash, so the upsert above leaves them
+# alone instead of writing a new row version (and firing the geo_location trigger).
+# ALTER TABLE takes an ACCESS EXCLUSIVE lock even when the column exists, which
+# would queue behind the open batches of the other workers and block every
+# reader behind it, so it only runs when the column is missing.
+def add_content_hash_column(cursor):
+    cursor.execute("""
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_schema = ANY(current_schemas(false))
+        AND table_name = 'mrag_ca_addresses'
+        AND column_name = 'content_hash'
+    """)
+    if cursor.fetchone() is None:
+        cursor.execute("ALTER TABLE mrag_ca_addresses ADD COLUMN IF NOT EXISTS content_hash varchar(32) NULL")
+
+# md5 of the normalized output columns, computed after region and city are filled
+def content_hash(address):
+    return hashlib.md5(repr(address).encode('utf-8')).hexdigest()
+
+def with_content_hashes(addresses):
+    return [address + (content_hash(address),) for address in addresses]
+
+def new_counts():
+    return {'inserted': 0, 'changed': 0, 'unchanged': 0}
+
+# Insert addresses into mrag_ca_addresses table. The tuples carry their content
+# hash; the inserted, changed and unchanged rows are added to counts.
+def insert_addresses(cursor, addresses, counts):
+    insert_query = f"""
+        INSERT INTO mrag_ca_addresses ({', '.join(WRITE_COLUMNS)})
+        VALUES ({', '.join(['%s'] * len(WRITE_COLUMNS))})
+        ON CONFLICT (id) DO UPDATE SET {UPSERT_SET}
+        RETURNING (xmax = 0) AS inserted;
     """
     for address in addresses:
         try:
             cursor.execute("SAVEPOINT before_insert")
             cursor.execute(insert_query, address)
+            result = cursor.fetchone()
+            if result is None:
+                counts['unchanged'] += 1
+            elif result['inserted']:
+                counts['inserted'] += 1
+            else:
+                counts['changed'] += 1
         except Exception as e:
             print(address)
             print(f"Error: {e}")
             cursor.execute("ROLLBACK TO SAVEPOINT before_insert")
-        
-# Function to check and set region and city based on boundaries
-def check_and_set_region_city(cursor, latitude, longitude):
-    query = """
-    SELECT name, place, bound
+
+# Create the quarantine table for rows that could not be loaded and the
+# session's staging table used by copy_addresses
+def prepare_bulk_load(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mrag_ca_addresses_quarantine (
+            id varchar(32) NULL,
+            data jsonb NULL,
+            error text NULL,
+            created_at timestamptz DEFAULT now() NOT NULL
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS mrag_ca_addresses_staging
+        ON COMMIT DELETE ROWS AS
+        SELECT {', '.join(WRITE_COLUMNS)}, 0 AS seq
+        FROM mrag_ca_addresses
+        WITH NO DATA
+    """)
+
+# Merge the staging table into mrag_ca_addresses. Returns the (inserted, changed) rows.
+def _merge_staging(cursor, server_geometry=False):
+    # The last row wins when a batch holds the same id twice, like the row by row upsert
+    if server_geometry:
+        # The boundary never left the database, take it from planet_osm_polygon
+        columns = ', '.join('p.way' if column == 'boundary' else 's.' + column for column in WRITE_COLUMNS)
+        merge = f"""
+            INSERT INTO mrag_ca_addresses ({', '.join(WRITE_COLUMNS)})
+            SELECT DISTINCT ON (s.id) {columns}
+            FROM mrag_ca_addresses_staging s
+            LEFT JOIN planet_osm_polygon p ON p.osm_id = s.id::bigint
+            ORDER BY s.id, s.seq DESC
+            ON CONFLICT (id) DO UPDATE SET {UPSERT_SET}
+            RETURNING (xmax = 0) AS inserted
+        """
+    else:
+        merge = f"""
+            INSERT INTO mrag_ca_addresses ({', '.join(WRITE_COLUMNS)})
+            SELECT DISTINCT ON (id) {', '.join(WRITE_COLUMNS)}
+            FROM mrag_ca_addresses_staging
+            ORDER BY id, seq DESC
+            ON CONFLICT (id) DO UPDATE SET {UPSERT_SET}
+            RETURNING (xmax = 0) AS inserted
+        """
+    # Rows skipped by the content hash check are not returned
+    cursor.execute(f"""
+        WITH merged AS ({merge})
+        SELECT count(*) FILTER (WHERE inserted) AS inserted,
+               count(*) FILTER (WHERE NOT inserted) AS changed
+        FROM merged
+    """)
+    result = cursor.fetchone()
+    cursor.execute("TRUNCATE mrag_ca_addresses_staging")
+    return result['inserted'], result['changed']
+
+# Returns the (inserted, changed, unchanged) rows of the batch
+def _load_batch(cursor, addresses, server_geometry=False):
+    buffer = io.StringIO()
+    for seq, address in enumerate(addresses):
+        buffer.write(sinks.copy_line(address + (seq,)))
+    buffer.seek(0)
+
+    cursor.execute("SAVEPOINT bulk_load")
+    try:
+        cursor.copy_expert(f"COPY mrag_ca_addresses_staging ({', '.join(WRITE_COLUMNS)}, seq) FROM STDIN", buffer)
+        inserted, changed = _merge_staging(cursor, server_geometry)
+    except Exception:
+        # On a dropped connection there is nothing to roll back, the original error is what counts
+        if not cursor.connection.closed:
+            try:
+                cursor.execute("ROLLBACK TO SAVEPOINT bulk_load")
+                cursor.execute("RELEASE SAVEPOINT bulk_load")
+            except psycopg2.Error:
+                pass
+        raise
+    cursor.execute("RELEASE SAVEPOINT bulk_load")
+    merged = len({address[0] for address in addresses})
+    return inserted, changed, merged - inserted - changed
+
+# Load a file written by sinks.CopyFileSink with one COPY and one merge.
+# Returns the (inserted, changed, unchanged) rows.
+def load_copy_file(cursor, file, server_geometry=False):
+    cursor.copy_expert(f"COPY mrag_ca_addresses_staging ({', '.join(WRITE_COLUMNS)}, seq) FROM STDIN", file)
+    cursor.execute("SELECT count(DISTINCT id) AS count FROM mrag_ca_addresses_staging")
+    merged = cursor.fetchone()['count']
+    inserted, changed = _merge_staging(cursor, server_geometry)
+    return inserted, changed, merged - inserted - changed
+
+def quarantine_address(cursor, address, error):
+    data = dict(zip(WRITE_COLUMNS, address))
+    cursor.execute("""
+        INSERT INTO mrag_ca_addresses_quarantine (id, data, error)
+        VALUES (%s, %s, %s)
+    """, (str(data['id']), Json(data, dumps=lambda obj: json.dumps(obj, default=str)), str(error).strip()))
+
+# COPY a batch into the staging table and merge it with one set-based upsert.
+# A batch rejected for its data is split in halves until the bad rows are isolated, and those
+# are written to mrag_ca_addresses_quarantine. Returns the number of rows quarantined
+# and adds the inserted, changed and unchanged rows to counts.
+# With server_geometry the boundary is joined from planet_osm_polygon instead.
+def copy_addresses(cursor, addresses, counts, server_geometry=False):
+    if not addresses:
+        return 0
+    try:
+        inserted, changed, unchanged = _load_batch(cursor, addresses, server_geometry)
+        counts['inserted'] += inserted
+        counts['changed'] += changed
+        counts['unchanged'] += unchanged
+        return 0
+    # Only errors caused by the data of a row are worth bisecting, the others
+    # (a dropped connection, a cancelled query, a serialization failure) fail
+    # every half the same way
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        if len(addresses) == 1:
+            quarantine_address(cursor, addresses[0], e)
+            return 1
+    middle = len(addresses) // 2
+    return copy_addresses(cursor, addresses[:middle], counts, server_geometry) + copy_addresses(cursor, addresses[middle:], counts, server_geometry)
+
+REGION_CITY_QUERY = """
+    SELECT name, place
     FROM mrag_boundary_data
     WHERE ST_Contains(bound, ST_SetSRID(ST_Point(%s, %s), 4326))
-    """
-    cursor.execute(query, (longitude, latitude))
+"""
+
+# Function to check and set region and city based on boundaries
+def check_and_set_region_city(cursor, latitude, longitude):
+    cursor.execute(REGION_CITY_QUERY, (longitude, latitude))
     results = cursor.fetchall()
     
     region = None
@@ -656,153 +869,198 @@ def check_and_set_region_city(cursor, latitude, longitude):
 
     return region, city        
 
-def extract_parts(house_no, street_name):
-    def clean_and_split(input_str):
-        input_str = input_str.strip().replace('"', '').replace("'", "").replace('`', '')
-        parts = re.split(r'[;,/&\-]', input_str)        
-        if (match := re.match(r'^(\d+\w*)\s+((\d+\w*\s+)+\d+\w*)$', house_no)): 
-            parts = [match.group(1)]  # extract first item of 1 2 3 4 5
-        elif(len(parts) == 2 and bool(re.search(r'^\d+\s+1\/2$', input_str))): 
-            parts = [input_str.strip()] # for cases like: "11 1/2"
-        elif(len(parts) == 2 and bool(re.search(r',', input_str))):
-            parts = [input_str.strip()]
-        elif(len(parts) == 2 and bool(re.search(r'\S-\S', input_str))) or (len(parts) == 2 and bool(re.search(r'\S-$', input_str))):
-            parts = [input_str.strip()]
+# Rank of the places in mrag_boundary_data, the most local one is used as city
+PLACE_RANKS = {'state': 1, 'city': 2, 'town': 3, 'village': 4, 'hamlet': 5}
+
+# In-memory version of check_and_set_region_city: mrag_boundary_data is loaded
+# once into an STRtree of prepared geometries and points are looked up in-process.
+class BoundaryIndex:
+    def __init__(self, boundaries):
+        # boundaries: (name, place, geometry) tuples
+        self.names = [name for name, place, geometry in boundaries]
+        self.places = [place for name, place, geometry in boundaries]
+        self.prepared = [prep(geometry) for name, place, geometry in boundaries]
+        self.tree = STRtree([geometry for name, place, geometry in boundaries])
+
+    @classmethod
+    def load(cls, cursor):
+        cursor.execute("""
+            SELECT name, place, ST_AsBinary(bound) AS bound
+            FROM mrag_boundary_data
+            WHERE bound IS NOT NULL AND NOT ST_IsEmpty(bound)
+        """)
+        return cls([(row['name'], row['place'], load_wkb(bytes(row['bound']))) for row in cursor.fetchall()])
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, latitude, longitude):
+        point = Point(float(longitude), float(latitude))
+        region = None
+        city = None
+        city_rank = 0
+        # The tree only filters by bounding box, containment is tested on the prepared geometry
+        for i in sorted(self.tree.query(point)):
+            if not self.prepared[i].contains(point):
+                continue
+            if self.places[i] == 'state':
+                region = self.names[i]
+            elif PLACE_RANKS.get(self.places[i], len(PLACE_RANKS) + 1) >= city_rank:
+                city = self.names[i]
+                city_rank = PLACE_RANKS.get(self.places[i], len(PLACE_RANKS) + 1)
+        return region, city
+
+# House number parsing. The patterns are compiled once and tried in order by
+# _process_house_no; plain numbers like "4515" or "12B" skip them completely.
+SPLIT_HOUSE_NO = re.compile(r'[;,/&\-]')
+LIST_OF_NUMBERS = re.compile(r'^(\d+\w*)\s+((\d+\w*\s+)+\d+\w*)$')
+HALF_NUMBER = re.compile(r'^\d+\s+1\/2$')
+COMMA = re.compile(r',')
+INNER_DASH = re.compile(r'\S-\S')
+TRAILING_DASH = re.compile(r'\S-$')
+PARENTHESES = re.compile(r'(\d+\s*\([\d+|\w+]\)?|\d+\s*\[[\d+|\w+]\]?)')
+DIGITS = re.compile(r'\d+')
+DIGITS_OR_WORD = re.compile(r'\d+|\w+')
+DOT_FRACTION = re.compile(r'^[0\s]*\.(\d+)$')
+DECIMAL = re.compile(r'^\d+\.\d+$')
+NUMBER_ALPHA = re.compile(r'^(\d+)(\w*)$|^(\d+)\s(\w)$|^(\d+)\s+([\w\s]{2,})$')
+STREET_NUMBER = re.compile(r'\s*(\d+)\s*(\w{1})?(\s+\S*)?')
+
+def clean_and_split(house_no):
+    input_str = house_no.strip().replace('"', '').replace("'", "").replace('`', '')
+    parts = SPLIT_HOUSE_NO.split(input_str)
+    if (match := LIST_OF_NUMBERS.match(house_no)):
+        parts = [match.group(1)]  # extract first item of 1 2 3 4 5
+    elif(len(parts) == 2 and bool(HALF_NUMBER.search(input_str))):
+        parts = [input_str.strip()] # for cases like: "11 1/2"
+    elif(len(parts) == 2 and bool(COMMA.search(input_str))):
+        parts = [input_str.strip()]
+    elif(len(parts) == 2 and bool(INNER_DASH.search(input_str))) or (len(parts) == 2 and bool(TRAILING_DASH.search(input_str))):
+        parts = [input_str.strip()]
+    else:
+        parts = [part.strip() for part in parts if part.strip()]
+    return parts
+
+def find_difference_position(s1, s2):
+    len1, len2 = len(s1), len(s2)
+    min_len = min(len1, len2)        
+    # Find the first position where the characters differ
+    for i in range(min_len):
+        if s1[i] != s2[i]:
+            return i        
+    # If no difference is found in the overlapping part, check the lengths
+    if len1 != len2:
+        return min_len        
+    return -1
+
+# Each handler gets the match and the house number and returns (unit_number, house_no)
+def _half(match, house_no): # for cases like: "11 1/2"
+    return None, match.group(1) + " ½"
+
+def _unit_then_number(match, house_no):
+    return match.group(1), match.group(2)
+
+def _number_then_unit(match, house_no):
+    return match.group(2), match.group(1)
+
+def _similar_numbers(match, house_no): # for cases like: "103A,103B"
+    s1, s2 = match.groups()
+    if Levenshtein.distance(s1, s2) <= 1:
+        return None, s1
+    return s1, s2
+
+def _similar_parts(match, house_no): # for cases like: "1206 1,1206 2"
+    s1, s2 = match.groups()
+    if Levenshtein.distance(s1, s2) <= 1:
+        cut_pos = find_difference_position(s1, s2)
+        if cut_pos > -1:
+            return s1[cut_pos:].strip(), s1[:cut_pos].strip()
+        return None, s1
+    return s1, s2
+
+def _trailing_dash(match, house_no):
+    return match.group(1), house_no
+
+def _unit_prefix(match, house_no):
+    return match.group(1), match.group(3)
+
+def _number_unit_suffix(match, house_no):
+    return match.group(3), match.group(1)
+
+def _leading_comma(match, house_no):
+    return None, match.group(2)
+
+HOUSE_NO_RULES = [
+    (re.compile(r'^(\d+)\s+1\/2$', re.IGNORECASE), _half),
+    (re.compile(r'^([\d|\w]+)[\-\s]+(\d+\w?)$', re.IGNORECASE), _unit_then_number),
+    (re.compile(r'^(\d+\w?),(\d+\w?)$', re.IGNORECASE), _similar_numbers),
+    (re.compile(r'^([^,]+\S),(\S[^,]+)$', re.IGNORECASE), _similar_parts),
+    (re.compile(r'^([\d|\w]+),\s+(\d+\w?).*$', re.IGNORECASE), _unit_then_number),
+    (re.compile(r'^([^-]+)-\s*$', re.IGNORECASE), _trailing_dash),
+    (re.compile(r'^unit\s*(\S*)([,\-\s]\s*(\d+\s*\w?))?', re.IGNORECASE), _unit_prefix),
+    (re.compile(r'^(\d+\s*\w?)([,\s]+unit\s*(\S*))', re.IGNORECASE), _number_unit_suffix),
+    (re.compile(r'^#([^,\-\s]+)([,\-\s]\s*(\d+\s*\w?))?', re.IGNORECASE), _unit_prefix),
+    (re.compile(r'^(,\s*)(\d+\s*\w?)', re.IGNORECASE), _leading_comma),
+    (re.compile(r'^([^\.]+)\.\.\.[^-]+-(\S*)', re.IGNORECASE), _unit_then_number),
+    (re.compile(r'^(\d+\s*\w?)\s+([^-]+)-(\S+)$', re.IGNORECASE), _number_then_unit),
+]
+
+def _process_house_no(house_no):
+    if not house_no:
+        return None, None, None
+    house_no = house_no.strip().upper()
+    unit_number = None
+    number_part = None
+    alpha_part = None
+
+    # Handle unit number
+    for pattern, handler in HOUSE_NO_RULES:
+        if (match := pattern.match(house_no)):
+            unit_number, house_no = handler(match, house_no)
+            break
+
+    # Handle parentheses
+    if house_no:       
+        if PARENTHESES.search(house_no):
+            number_part = DIGITS.findall(house_no.split('(')[0])[0]
+            alpha_part = DIGITS_OR_WORD.findall(house_no.split('(')[1])[0]
         else:
-            parts = [part.strip() for part in parts if part.strip()]  
-        return parts
-
-    def find_difference_position(s1, s2):
-        len1, len2 = len(s1), len(s2)
-        min_len = min(len1, len2)        
-        # Find the first position where the characters differ
-        for i in range(min_len):
-            if s1[i] != s2[i]:
-                return i        
-        # If no difference is found in the overlapping part, check the lengths
-        if len1 != len2:
-            return min_len        
-        return -1
-    
-    def process_house_no(house_no):
-        if not house_no:
-            return None, None, None
-        house_no = house_no.strip().upper()
-        unit_number = None
-        number_part = None
-        alpha_part = None
-
-        # Handle unit number
-        if (match := re.match(r'^(\d+)\s+1\/2$', house_no, re.IGNORECASE)): # for cases like: "11 1/2"
-            parts = match.groups()          
-            house_no = parts[0] + " ½"
-        elif (match := re.match(r'^([\d|\w]+)[\-\s]+(\d+\w?)$', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]
-            house_no = parts[1]
-        elif (match := re.match(r'^(\d+\w?),(\d+\w?)$', house_no, re.IGNORECASE)): # for cases like: "103A,103B"
-            parts = match.groups()
-            s1 = parts[0]
-            s2 = parts[1]
-            if Levenshtein.distance(s1, s2) <= 1:
-                house_no = s1
-            else:
-                unit_number = s1
-                house_no = s2
-        elif (match := re.match(r'^([^,]+\S),(\S[^,]+)$', house_no, re.IGNORECASE)): # for cases like: "1206 1,1206 2"
-            parts = match.groups()
-            s1 = parts[0]
-            s2 = parts[1]
-            if Levenshtein.distance(s1, s2) <= 1:
-                cut_pos = find_difference_position(s1, s2)
-                if cut_pos > -1:
-                    house_no = s1[:cut_pos].strip()
-                    unit_number = s1[cut_pos:].strip()
-                else:
-                    house_no = s1
-            else:
-                unit_number = s1
-                house_no = s2
-        elif (match := re.match(r'^([\d|\w]+),\s+(\d+\w?).*$', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]           
-            house_no = parts[1]
-        elif (match := re.match(r'^([^-]+)-\s*$', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]     
-        elif (match := re.match(r'^unit\s*(\S*)([,\-\s]\s*(\d+\s*\w?))?', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]
-            if len(parts) > 2:
-                house_no = parts[2]
-            else:
-                house_no = None
-        elif (match := re.match(r'^(\d+\s*\w?)([,\s]+unit\s*(\S*))', house_no, re.IGNORECASE)): 
-            parts = match.groups()
-            house_no = parts[0]
-            if len(parts) > 2:
-                unit_number = parts[2]
-        elif (match := re.match(r'^#([^,\-\s]+)([,\-\s]\s*(\d+\s*\w?))?', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]            
-            if len(parts) > 2:
-                house_no = parts[2]
-            else:
-                house_no = None
-        elif (match := re.match(r'^(,\s*)(\d+\s*\w?)', house_no, re.IGNORECASE)):
-            parts = match.groups()           
-            if len(parts) > 1:
-                house_no = parts[1]
-        elif (match := re.match(r'^([^\.]+)\.\.\.[^-]+-(\S*)', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            unit_number = parts[0]
-            house_no = parts[1]
-        elif (match := re.match(r'^(\d+\s*\w?)\s+([^-]+)-(\S+)$', house_no, re.IGNORECASE)):
-            parts = match.groups()
-            house_no = parts[0]
-            unit_number = parts[1]
-                    
-        # Handle parentheses
-        if house_no:       
-            if re.search(r'(\d+\s*\([\d+|\w+]\)?|\d+\s*\[[\d+|\w+]\]?)', house_no):
-                number_part = re.findall(r'\d+', house_no.split('(')[0])[0]
-                alpha_part = re.findall(r'\d+|\w+', house_no.split('(')[1])[0]
-            else:
-                # Handle 0.x and .x cases
-                if (match := re.match(r'^[0\s]*\.(\d+)$', house_no)):
-                    number_part = match.groups()[0]
-                # Handle x.x and x.5 cases
-                elif re.match(r'^\d+\.\d+$', house_no):
-                    number_part, alpha_part = house_no.split('.')
-                    alpha_part = '.' + alpha_part
-                elif (match:= re.match(r'^(\d+)(\w*)$|^(\d+)\s(\w)$|^(\d+)\s+([\w\s]{2,})$', house_no)):
-                    street_parts = match.groups()
-                    if street_parts[0] is not None:
-                        number_part = street_parts[0].strip()
-                        if street_parts[1] is not None:
-                            alpha_part = street_parts[1].strip()
-
-                    if street_parts[2] is not None:
-                        number_part = street_parts[2].strip()                      
-                        if street_parts[3] is not None:
-                            alpha_part = street_parts[3].strip()
-                    if street_parts[4] is not None:
-                        number_part = street_parts[4].strip()
-
-            # Convert alpha part to uppercase
-            alpha_part = alpha_part.upper() if alpha_part else None
-
-        return unit_number, number_part, alpha_part
+            # Handle 0.x and .x cases
+            if (match := DOT_FRACTION.match(house_no)):
+                number_part = match.groups()[0]
+            # Handle x.x and x.5 cases
+            elif DECIMAL.match(house_no):
+                number_part, alpha_part = house_no.split('.')
+                alpha_part = '.' + alpha_part
+            elif (match:= NUMBER_ALPHA.match(house_no)):
+                street_parts = match.groups()
+                if street_parts[0] is not None:
+                    number_part = street_parts[0].strip()
+                    if street_parts[1] is not None:
+                        alpha_part = street_parts[1].strip()
 
+                if street_parts[2] is not None:
+                    number_part = street_parts[2].strip()                      
+                    if street_parts[3] is not None:
+                        alpha_part = street_parts[3].strip()
+                if street_parts[4] is not None:
+                    number_part = street_parts[4].strip()
+
+        # Convert alpha part to uppercase
+        alpha_part = alpha_part.upper() if alpha_part else None
+
+    return unit_number, number_part, alpha_part
+
+def _extract_parts(house_no, street_name):
     # Clean and split the house_no string
     parts = clean_and_split(house_no)
 
     # Process the cleaned parts
-    unit_number, number_part, alpha_part = process_house_no(parts[0])
+    unit_number, number_part, alpha_part = _process_house_no(parts[0])
 
     # Handle specific case for extracting house number and alpha part from street name
     if street_name and (number_part == "" or number_part is None):
-        street_match = re.match(r'\s*(\d+)\s*(\w{1})?(\s+\S*)?', street_name)
+        street_match = STREET_NUMBER.match(street_name)
         if street_match:
             street_parts = street_match.groups()
             number_part = street_parts[0].strip()
@@ -811,72 +1069,722 @@ def extract_parts(house_no, street_name):
 
     return unit_number, number_part, alpha_part
 
-# Main script
-if __name__ == "__main__":
+# Results of the slow path are cached per (house_no, street_name)
+HOUSE_NO_CACHE = street_normalizer.LRUCache(100000)
+
+def extract_parts(house_no, street_name):
+    # Fast path: ASCII digits optionally followed by letters, e.g. "4515" or "12b"
+    if house_no.isascii() and house_no.isalnum() and house_no[0].isdigit():
+        i = 1
+        while i < len(house_no) and house_no[i].isdigit():
+            i += 1
+        return None, house_no[:i], house_no[i:].upper() or None
+    return HOUSE_NO_CACHE.get_or_compute((house_no, street_name), _extract_parts, house_no, street_name)
+
+# The street_no, house_number, house_alpha and unit columns of a house number
+def split_house_no(street_no, street):
+    unit, house_number, house_alpha = extract_parts(street_no, street)
+    if house_alpha is not None and house_alpha.isalpha():
+        street_no = house_number.strip() + house_alpha.strip()
+    elif house_alpha is not None:
+        street_no = house_number.strip() + "(" + house_alpha.strip() + ")"
+    elif house_number is not None:
+        street_no = house_number.strip()
+    else:
+        street_no = None
+    return street_no, house_number, house_alpha, unit
+
+# Build the mrag_ca_addresses tuple of one planet_osm_polygon row. This does not
+# touch the database, so it can run in worker processes; region and city are
+# filled in afterwards by fill_region_city when the tags have neither.
+def transform_row(row):
+    id = row['osm_id']
+    street_no = row['housenumber']
+    street = row['street']
+    street_full_name, street_name, street_type, street_quad = exchange_address_abbreviations(row['street'])
+    full_address = street_no + ' ' + street_full_name
+    postal_code = format_postal_code(row['postcode'])                
+    geo_latitude = row['latitude']
+    geo_longitude = row['longitude']
+    boundary = row.get('way')
+
+    street_no, house_number, house_alpha, unit = split_house_no(street_no, street)
+
+    # Determine region
+    state = row['state'] if 'state' in row and row['state'] else None
+    province = row['province'] if 'province' in row and row['province'] else None
+    region = state if state else province
+    
+    city = row['city'] if 'city' in row else None
+
+    return (id, street_full_name, street_name, street_type, street_quad, full_address, postal_code, geo_latitude, geo_longitude, boundary, region, city, street_no, house_number, house_alpha, unit)
+
+def transform_rows(rows):
+    return [transform_row(row) for row in rows]
+
+# Source columns of transform_columns, as named by ADDRESS_QUERY
+SOURCE_COLUMNS = ['osm_id', 'street', 'postcode', 'housenumber', 'state', 'province', 'city', 'longitude', 'latitude', 'way']
+
+def _column(columns, name, length):
+    # Lists, NumPy arrays and pyarrow arrays are all accepted; a missing column is all None
+    values = columns.get(name)
+    if values is None:
+        return [None] * length
+    if hasattr(values, 'to_pylist'):
+        return values.to_pylist()
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
+
+def rows_to_columns(rows):
+    return {name: [row.get(name) for row in rows] for name in SOURCE_COLUMNS}
+
+# Column by column version of transform_rows for a whole page: every distinct
+# street, postcode and (house number, street) pair of the page is normalized
+# once through the scalar functions, and the tuples are then assembled from the
+# lookups in one pass. Gives the same tuples as transform_rows.
+def transform_columns(columns):
+    osm_ids = _column(columns, 'osm_id', 0)
+    length = len(osm_ids)
+    streets = _column(columns, 'street', length)
+    postcodes = _column(columns, 'postcode', length)
+    house_numbers = _column(columns, 'housenumber', length)
+
+    normalized_streets = {street: exchange_address_abbreviations(street) for street in set(streets)}
+    formatted_postcodes = {postcode: format_postal_code(postcode) for postcode in set(postcodes)}
+    split_house_numbers = {key: split_house_no(*key) for key in set(zip(house_numbers, streets))}
+
+    addresses = []
+    for osm_id, street, postcode, house_no, state, province, city, latitude, longitude, boundary in zip(
+            osm_ids, streets, postcodes, house_numbers, _column(columns, 'state', length), _column(columns, 'province', length),
+            _column(columns, 'city', length), _column(columns, 'latitude', length), _column(columns, 'longitude', length),
+            _column(columns, 'way', length)):
+        street_full_name, street_name, street_type, street_quad = normalized_streets[street]
+        street_no, house_number, house_alpha, unit = split_house_numbers[house_no, street]
+        addresses.append((osm_id, street_full_name, street_name, street_type, street_quad, house_no + ' ' + street_full_name,
+                          formatted_postcodes[postcode], latitude, longitude, boundary, state or province or None, city,
+                          street_no, house_number, house_alpha, unit))
+    return addresses
+
+def transform_page(rows, columnar=False):
+    if columnar:
+        return transform_columns(rows_to_columns(rows))
+    return transform_rows(rows)
+
+def _transform_rows_in_worker(rows, columnar=False):
+    # The cache counters of the worker travel back with the result
+    return transform_page(rows, columnar), STREET_CACHE.take_counters(), HOUSE_NO_CACHE.take_counters()
+
+REGION_INDEX = ADDRESS_COLUMNS.index('region')
+CITY_INDEX = ADDRESS_COLUMNS.index('city')
+BOUNDARY_INDEX = ADDRESS_COLUMNS.index('boundary')
+LATITUDE_INDEX = ADDRESS_COLUMNS.index('geo_latitude')
+LONGITUDE_INDEX = ADDRESS_COLUMNS.index('geo_longitude')
+
+def _with_region_city(address, region, city):
+    address = list(address)
+    address[REGION_INDEX] = region
+    address[CITY_INDEX] = city
+    return tuple(address)
+
+# Look up region and city from mrag_boundary_data for the addresses without both,
+# either with one query per address or in a loaded BoundaryIndex
+def fill_region_city(cursor, addresses, boundary_index=None):
+    for i, address in enumerate(addresses):
+        if address[CITY_INDEX] is None and address[REGION_INDEX] is None:
+            if boundary_index is not None:
+                region, city = boundary_index.lookup(address[LATITUDE_INDEX], address[LONGITUDE_INDEX])
+            else:
+                region, city = check_and_set_region_city(cursor, address[LATITUDE_INDEX], address[LONGITUDE_INDEX])
+            addresses[i] = _with_region_city(address, region, city)
+    return addresses
+
+# Same as fill_region_city, but all addresses of the batch that need a region
+# and city are resolved with one LATERAL ST_Contains join in the database
+def fill_region_city_batch(cursor, addresses):
+    missing = [i for i, address in enumerate(addresses) if address[CITY_INDEX] is None and address[REGION_INDEX] is None]
+    if not missing:
+        return addresses
+    cursor.execute("""
+        SELECT p.n, b.region, b.city
+        FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS p(longitude, latitude, n)
+        CROSS JOIN LATERAL (
+            SELECT
+                (array_agg(name) FILTER (WHERE place = 'state'))[1] AS region,
+                (array_agg(name ORDER BY CASE place
+                    WHEN 'city' THEN 2
+                    WHEN 'town' THEN 3
+                    WHEN 'village' THEN 4
+                    WHEN 'hamlet' THEN 5
+                    ELSE 6
+                END DESC) FILTER (WHERE place <> 'state'))[1] AS city
+            FROM mrag_boundary_data
+            WHERE ST_Contains(bound, ST_SetSRID(ST_Point(p.longitude, p.latitude), 4326))
+        ) b
+    """, ([addresses[i][LONGITUDE_INDEX] for i in missing], [addresses[i][LATITUDE_INDEX] for i in missing]))
+    for row in cursor.fetchall():
+        i = missing[row['n'] - 1]
+        addresses[i] = _with_region_city(addresses[i], row['region'], row['city'])
+    return addresses
+
+def _without_geometry(rows):
+    # Workers do not need the polygon, so it is not pickled to them
+    return [{key: value for key, value in row.items() if key != 'way'} for row in rows]
+
+def _restore_geometry(addresses, rows):
+    return [address[:BOUNDARY_INDEX] + (row.get('way'),) + address[BOUNDARY_INDEX + 1:] for address, row in zip(addresses, rows)]
+
+def _collect_page(rows, result):
+    # In the main process the transform stage is the time spent waiting for the workers
+    with TIMERS.stage('transform', len(rows)):
+        addresses, street_counters, house_no_counters = result.get()
+    STREET_CACHE.add_counters(street_counters)
+    HOUSE_NO_CACHE.add_counters(house_no_counters)
+    return rows, _restore_geometry(addresses, rows)
+
+# Transform pages in a worker pool. Up to `depth` pages are in flight so the
+# reading and writing in this process overlap the parsing in the workers, and
+# pages are yielded in their original order as (rows, addresses).
+def transform_pages(pages, pool, depth, columnar=False):
+    in_flight = deque()
+    for rows in pages:
+        in_flight.append((rows, pool.apply_async(_transform_rows_in_worker, (_without_geometry(rows), columnar))))
+        if len(in_flight) >= depth:
+            yield _collect_page(*in_flight.popleft())
+    while in_flight:
+        yield _collect_page(*in_flight.popleft())
+
+# Per-stage timings of this process, see configure_metrics
+TIMERS = run_metrics.StageTimers('osm2mrag')
+PROFILER = None
+
+def configure_metrics(args, position=None):
+    global PROFILER
+    labels = {'command': args.command, 'run': args.run}
+    if position is not None:
+        labels['process'] = position
+    TIMERS.configure(run_metrics.per_process_path(args.metrics_log, position) if position is not None else args.metrics_log,
+                     run_metrics.per_process_path(args.metrics_textfile, position) if position is not None else args.metrics_textfile,
+                     args.metrics_interval, **labels)
+    if args.profile:
+        path = run_metrics.per_process_path(args.profile, position) if position is not None else args.profile
+        PROFILER = run_metrics.BatchProfiler(path, args.profile_skip, args.profile_batches)
+
+# Write the last metrics and the profile of a run that ended inside the profiled window
+def finish_metrics():
+    TIMERS.emit()
+    if PROFILER is not None:
+        PROFILER.close()
+
+def _transform_page_timed(rows, columnar):
+    with TIMERS.stage('transform', len(rows)):
+        return transform_page(rows, columnar)
+
+# Read, transform, write and commit the pages one after the other. `state` keeps
+# the progress for error reports; on_commit runs inside each batch's transaction.
+def process_pages(conn, cursor, pages, args, state, sink, pool=None, boundary_index=None, pbar=None, on_commit=None):
+    pages = TIMERS.iterate('fetch', pages)
+    columnar = args.transform == 'columns'
+    if pool is not None:
+        transformed = transform_pages(pages, pool, 2 * args.workers, columnar)
+    else:
+        transformed = ((rows, _transform_page_timed(rows, columnar)) for rows in pages)
+
+    for rows, addresses in transformed:
+        state['addresses'] = addresses
+        with TIMERS.stage('region_city', len(addresses)):
+            if args.boundaries == 'batch':
+                fill_region_city_batch(cursor, addresses)
+            else:
+                fill_region_city(cursor, addresses, boundary_index)
+
+        with TIMERS.stage('write', len(addresses)):
+            sink.write(with_content_hashes(addresses))
+
+        with TIMERS.stage('commit', len(rows)):
+            if on_commit is not None:
+                on_commit(rows)
+            conn.commit()
+
+        state['offset'] += args.batch_size
+        state['last_osm_id'] = rows[-1]['osm_id']
+        if pbar is not None:
+            pbar.update(len(rows))
+        TIMERS.maybe_emit()
+        if PROFILER is not None:
+            PROFILER.batch_done()
+
+# Writes the batches into mrag_ca_addresses, with COPY (--writer copy) or row by row
+class PostgresSink:
+    def __init__(self, conn, cursor, args):
+        self.writer = args.writer
+        self.server_geometry = args.geometry == 'server'
+        self.counts = new_counts()
+        self.quarantined = 0
+        self.connect(conn, cursor)
+
+    # Also called by run_worker with a new connection when the old one dropped,
+    # the staging table of the copy writer belongs to the session
+    def connect(self, conn, cursor):
+        self.cursor = cursor
+        add_content_hash_column(cursor)
+        if self.writer == 'copy':
+            prepare_bulk_load(cursor)
+        conn.commit()
+
+    def write(self, addresses):
+        if self.writer == 'copy':
+            self.quarantined += copy_addresses(self.cursor, addresses, self.counts, self.server_geometry)
+        else:
+            insert_addresses(self.cursor, addresses, self.counts)
+
+    def close(self):
+        pass
+
+    def stats(self):
+        counts = self.counts
+        lines = [f"Inserted {counts['inserted']}, changed {counts['changed']} and skipped {counts['unchanged']} unchanged rows"]
+        if self.quarantined:
+            lines.append(f"{self.quarantined} rows could not be loaded, see mrag_ca_addresses_quarantine")
+        return lines
+
+def open_sink(conn, cursor, args):
+    if args.sink == 'parquet':
+        return sinks.ParquetSink(args.output, parquet_io.output_schema(WRITE_COLUMNS))
+    if args.sink == 'copy-file':
+        return sinks.CopyFileSink(args.output)
+    if args.sink == 'dry-run':
+        return sinks.DryRunSink()
+    return PostgresSink(conn, cursor, args)
+
+def address_query(args):
+    return ADDRESS_QUERY if args.geometry == 'client' else ADDRESS_QUERY_WITHOUT_GEOMETRY
+
+def parquet_pages(args, after_osm_id=None, until_osm_id=None):
+    geometry = args.geometry == 'client'
+    if geometry and not parquet_io.has_geometry(args.parquet_dir):
+        raise Exception(f"The extract in {args.parquet_dir} has no polygons, use --geometry server or extract with --parquet-geometry")
+    return parquet_io.iter_pages(args.parquet_dir, args.batch_size, after_osm_id, until_osm_id, geometry)
+
+def open_pool(args):
+    if args.workers > 0:
+        return multiprocessing.Pool(args.workers, initializer=set_street_cache_size, initargs=(args.street_cache_size,))
+    return None
+
+def print_run_stats(state, sink):
+    for line in sink.stats():
+        print(line)
+    print(f"Street cache: {STREET_CACHE.stats()}")
+    print(f"House number cache: {HOUSE_NO_CACHE.stats()}")
+    for line in TIMERS.report():
+        print(line)
+
+def new_state():
+    return {'addresses': [], 'offset': 0, 'last_osm_id': None}
+
+# Single process import of the whole table (the default command)
+def run_import(args):
+    conn = None
+    read_conn = None
+    cursor = None
+    pool = None
+    sink = None
+    state = new_state()
     try:
         conn = connect_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        limit = 1000
-        offset = 0
-        
+
+        sink = open_sink(conn, cursor, args)
+
+        # Offset pages have no stable order, so only keyset and stream runs are checkpointed.
+        # Rows written to a file or dropped by a dry run are not checkpointed either.
+        checkpoint = None
+        save = None
+        if args.scan != 'offset' and args.sink == 'postgres':
+            jobs.create_checkpoint_table(cursor)
+            if args.resume:
+                checkpoint = jobs.load_checkpoint(cursor, args.run)
+                if checkpoint is None:
+                    print(f"No checkpoint for run '{args.run}', starting from the beginning")
+                else:
+                    print(f"Resuming run '{args.run}' after osm_id {checkpoint['last_osm_id']} ({checkpoint['rows_done']} rows done)")
+            else:
+                jobs.reset_checkpoint(cursor, args.run)
+            conn.commit()
+            save = lambda rows: jobs.save_checkpoint(cursor, args.run, rows[-1]['osm_id'], len(rows))
+        after_osm_id = checkpoint['last_osm_id'] if checkpoint else None
+        state['last_osm_id'] = after_osm_id
+
+        boundary_index = None
+        if args.boundaries == 'memory':
+            boundary_index = BoundaryIndex.load(cursor)
+            print(f"Loaded {len(boundary_index)} boundaries")
+
         # Initialize total_rows for the progress bar
-        cursor.execute("SELECT COUNT(*) FROM planet_osm_polygon WHERE tags ? 'addr:street' AND tags ? 'addr:postcode' AND tags ? 'addr:housenumber'")
-        total_rows = cursor.fetchone()['count'] - offset
+        if args.source == 'parquet':
+            total_rows = max(parquet_io.count_rows(args.parquet_dir) - (checkpoint['rows_done'] if checkpoint else 0), 0)
+        elif args.scan == 'offset':
+            total_rows = count_addresses(cursor)
+        else:
+            total_rows = max(estimate_addresses(cursor) - (checkpoint['rows_done'] if checkpoint else 0), 0)
 
-        with tqdm(total=total_rows, desc="Processing addresses") as pbar:
-            while True:
-                rows = get_addresses_from_db(cursor, limit, offset)
-                if not rows:
-                    break
+        if args.source == 'parquet':
+            pages = parquet_pages(args, after_osm_id)
+        elif args.scan == 'stream':
+            read_conn = connect_db()
+            read_conn.set_session(readonly=True)
+            pages = stream_addresses(read_conn, args.batch_size, args.itersize, address_query(args), after_osm_id)
+        else:
+            pages = iter_address_pages(cursor, args.batch_size, args.scan, address_query(args), after_osm_id)
 
-                addresses = []
-                for row in rows:
-                    id = row['osm_id']
-                    street_no = row['housenumber']
-                    street = row['street']
-                    street_full_name, street_name, street_type, street_quad = exchange_address_abbreviations(row['street'])
-                    full_address = street_no + ' ' + street_full_name
-                    postal_code = format_postal_code(row['postcode'])                
-                    geo_latitude = row['latitude']
-                    geo_longitude = row['longitude']
-                    boundary = row['way']
-
-                    unit, house_number, house_alpha = extract_parts(street_no, street)
-                    if house_alpha is not None and house_alpha.isalpha():
-                        street_no = house_number.strip() + house_alpha.strip()
-                    elif house_alpha is not None:
-                        street_no = house_number.strip() + "(" + house_alpha.strip() + ")"
-                    elif house_number is not None:
-                        street_no = house_number.strip()
-                    else:
-                        street_no = None
-
-                    # Determine region
-                    state = row['state'] if 'state' in row and row['state'] else None
-                    province = row['province'] if 'province' in row and row['province'] else None
-                    region = state if state else province
-                    
-                    city = row['city'] if 'city' in row else None
-                    
-                    if city is None and region is None:
-                        region, city = check_and_set_region_city(cursor, geo_latitude, geo_longitude)
-                    
-                    address = (id, street_full_name, street_name, street_type, street_quad, full_address, postal_code, geo_latitude, geo_longitude, boundary, region, city, street_no, house_number, house_alpha, unit)
-                    addresses.append(address)
-
-                insert_addresses(cursor, addresses)
-                conn.commit()
-                
-                offset += limit
-                pbar.update(len(rows))
+        pool = open_pool(args)
+        with tqdm(total=total_rows, desc="Processing addresses") as pbar:
+            process_pages(conn, cursor, pages, args, state, sink, pool, boundary_index, pbar, on_commit=save)
+        print_run_stats(state, sink)
 
     except Exception as e:
-        print(addresses)
+        print(state['addresses'])
         print(f"Error: {e}")
-        print(f"Offset: {offset}")        
+        print(f"Offset: {state['offset']}")
+        print(f"Last osm_id: {state['last_osm_id']}")
+        if args.scan != 'offset' and args.sink == 'postgres':
+            print(f"Run 'python main.py --resume --run {args.run}' with the same options to continue after the last committed batch")
     finally:
+        finish_metrics()
+        if sink:
+            sink.close()
+        if pool:
+            pool.terminate()
         if cursor:
             cursor.close()
         if conn:
             conn.close()
+        if read_conn:
+            read_conn.close()
+
+# Merge a COPY file written by --sink copy-file into mrag_ca_addresses in one transaction
+def run_load(args):
+    conn = connect_db()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        add_content_hash_column(cursor)
+        prepare_bulk_load(cursor)
+        conn.commit()
+        with open(args.output, encoding='utf-8') as file:
+            inserted, changed, unchanged = load_copy_file(cursor, file, args.geometry == 'server')
+        conn.commit()
+        print(f"Inserted {inserted}, changed {changed} and skipped {unchanged} unchanged rows")
+    finally:
+        cursor.close()
+        conn.close()
+
+# Dump the address rows of planet_osm_polygon into Parquet files for --source parquet
+def run_extract(args):
+    read_conn = connect_db()
+    try:
+        read_conn.set_session(readonly=True)
+        cursor = read_conn.cursor(cursor_factory=RealDictCursor)
+        total_rows = estimate_addresses(cursor)
+        cursor.close()
+        query = EXTRACT_QUERY if args.parquet_geometry else ADDRESS_QUERY_WITHOUT_GEOMETRY
+        pages = TIMERS.iterate('fetch', stream_addresses(read_conn, args.batch_size, args.itersize, query))
+        with tqdm(total=total_rows, desc="Extracting addresses") as pbar:
+            written = parquet_io.write_extract(args.parquet_dir, pages, args.rows_per_file, args.parquet_geometry,
+                                               on_page=lambda written: pbar.update(written - pbar.n))
+        print(f"Extracted {written} rows into {len(parquet_io.extract_files(args.parquet_dir))} files in {args.parquet_dir}")
+    finally:
+        finish_metrics()
+        read_conn.close()
+
+# Split the address rows into osm_id ranges in mrag_import_jobs
+def run_plan(args):
+    conn = connect_db()
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        jobs.create_job_table(cursor)
+        planned = jobs.plan_jobs(cursor, args.run, args.jobs, ADDRESS_FILTER)
+        conn.commit()
+        print(f"Planned {planned} jobs for run '{args.run}'")
+    finally:
+        conn.close()
+
+# Claim jobs of the run until none is left. Every worker has its own connection.
+def run_worker(args, position=0):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    if args.processes > 1:
+        configure_metrics(args, position)
+    conn = connect_db()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    pool = None
+    state = new_state()
+    try:
+        sink = PostgresSink(conn, cursor, args)
+
+        boundary_index = None
+        if args.boundaries == 'memory':
+            boundary_index = BoundaryIndex.load(cursor)
+
+        pool = open_pool(args)
+        with tqdm(desc=f"Worker {worker}", position=position) as pbar:
+            while True:
+                job = claim_job_with_commit(conn, cursor, args.run, worker, args.stale_minutes, args.max_attempts)
+                if job is None:
+                    break
+                if job['attempts'] > 1:
+                    print(f"Attempt {job['attempts']} of job {job['id']}")
+                try:
+                    # A job taken over from a failed worker continues after its checkpoint
+                    after_osm_id = job['checkpoint_osm_id'] if job['checkpoint_osm_id'] is not None else job['after_osm_id']
+                    if args.source == 'parquet':
+                        pages = parquet_pages(args, after_osm_id, job['last_osm_id'])
+                    else:
+                        pages = iter_address_pages(cursor, args.batch_size, 'keyset', address_query(args),
+                                                   after_osm_id=after_osm_id, until_osm_id=job['last_osm_id'])
+                    heartbeat = lambda rows, job_id=job['id']: jobs.heartbeat_job(cursor, job_id, len(rows), rows[-1]['osm_id'])
+                    process_pages(conn, cursor, pages, args, state, sink, pool, boundary_index, pbar, on_commit=heartbeat)
+                    jobs.finish_job(cursor, job['id'])
+                    conn.commit()
+                except Exception as e:
+                    # The job is retried, by this or another worker, up to --max-attempts
+                    print(f"Error in {worker} on job {job['id']}: {e}")
+                    print(f"Last osm_id: {state['last_osm_id']}")
+                    if conn.closed:
+                        # The connection dropped, which is what the queue has to survive
+                        conn = connect_db()
+                        cursor = conn.cursor(cursor_factory=RealDictCursor)
+                        sink.connect(conn, cursor)
+                    else:
+                        conn.rollback()
+                    jobs.fail_job(cursor, job['id'], e)
+                    conn.commit()
+        print_run_stats(state, sink)
+
+    except Exception as e:
+        # The setup, a claim or recording a failed job failed; a job this worker
+        # was running is taken over after --stale-minutes
+        print(f"Error in {worker}: {e}")
+        print(f"Last osm_id: {state['last_osm_id']}")
+    finally:
+        finish_metrics()
+        if pool:
+            pool.terminate()
+        cursor.close()
+        conn.close()
+
+# Install the changelog trigger on planet_osm_polygon
+def run_install_changelog(args):
+    conn = connect_db()
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        changelog.install_changelog(cursor, ADDRESS_FILTER)
+        conn.commit()
+        print("Installed the changelog trigger on planet_osm_polygon")
+    finally:
+        conn.close()
+
+# Re-process only the osm_ids recorded in the changelog since the last sync and
+# delete the addresses whose polygon disappeared. The processed changelog rows
+# are removed in the same transaction as their batch.
+def run_sync(args):
+    conn = connect_db()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    state = new_state()
+    state['deleted'] = 0
+    try:
+        sink = PostgresSink(conn, cursor, args)
+
+        boundary_index = None
+        if args.boundaries == 'memory':
+            boundary_index = BoundaryIndex.load(cursor)
+
+        max_change_id = changelog.last_change_id(cursor)
+        if max_change_id is None:
+            print("No changes to sync")
+            return
+
+        def apply_changes(osm_ids):
+            state['deleted'] += changelog.delete_vanished_addresses(cursor, osm_ids, ADDRESS_FILTER)
+            changelog.clear_changes(cursor, osm_ids, max_change_id)
+
+        last_osm_id = None
+        with tqdm(total=changelog.count_changed_ids(cursor, max_change_id), desc="Syncing changed addresses") as pbar:
+            while True:
+                osm_ids = changelog.get_changed_ids(cursor, args.batch_size, max_change_id, last_osm_id)
+                if not osm_ids:
+                    break
+                rows = changelog.get_addresses_by_ids(cursor, osm_ids, address_query(args))
+                if rows:
+                    process_pages(conn, cursor, [rows], args, state, sink, boundary_index=boundary_index,
+                                  on_commit=lambda rows, osm_ids=osm_ids: apply_changes(osm_ids))
+                else:
+                    apply_changes(osm_ids)
+                    conn.commit()
+                last_osm_id = osm_ids[-1]
+                pbar.update(len(osm_ids))
+
+        print(f"Deleted {state['deleted']} addresses whose polygon disappeared")
+        print_run_stats(state, sink)
+
+    except Exception as e:
+        print(state['addresses'])
+        print(f"Error: {e}")
+        print(f"Last osm_id: {state['last_osm_id']}")
+    finally:
+        finish_metrics()
+        cursor.close()
+        conn.close()
+
+# The queries run for every page or address, with sample parameters, and the
+# index each of them needs
+def hot_queries(args):
+    indexes = {index['name']: index for index in preflight.required_indexes(ADDRESS_FILTER)}
+    return [
+        ("address page", address_query(args) + """
+            ORDER BY osm_id
+            LIMIT %s
+        """, (args.batch_size,), indexes['planet_osm_polygon_idx_addresses']),
+        ("region and city lookup", REGION_CITY_QUERY, (-114.07, 51.05), indexes['mrag_boundary_data_idx_by_bound']),
+        ("ca_postcodes pending addresses", preflight.PENDING_POSTAL_CODES_QUERY, (args.region,),
+         indexes['mrag_ca_addresses_idx_pending_postal_codes']),
+    ]
+
+# EXPLAIN the hot queries and report sequential scans on large tables. With
+# --create-indexes the index a query needs is built CONCURRENTLY when it is
+# missing or invalid. Returns False when a problem is left.
+def run_preflight(args):
+    conn = connect_db()
+    conn.autocommit = True
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    ok = True
+    try:
+        for name, query, params, index in hot_queries(args):
+            if not preflight.table_exists(cursor, index['table']):
+                print(f"{name}: skipped, table {index['table']} does not exist")
+                continue
+
+            min_bytes = args.large_table_mb * 1024 * 1024
+            status = preflight.index_status(cursor, index['name'])
+            if status is not True and args.create_indexes:
+                print(f"{name}: creating index {index['name']} concurrently")
+                preflight.create_index(cursor, index)
+                status = preflight.index_status(cursor, index['name'])
+            scans = preflight.sequential_scans(cursor, query, params, min_bytes)
+
+            if status is False:
+                ok = False
+                print(f"{name}: index {index['name']} is invalid, drop it and create it again")
+            elif status is None:
+                ok = False
+                print(f"{name}: index {index['name']} is missing")
+                print(f"    CREATE INDEX CONCURRENTLY {index['name']} {index['definition']};")
+            for table, size in scans:
+                ok = False
+                print(f"{name}: sequential scan on {table} ({size / 1024 / 1024:.0f} MB)")
+            if not scans and status is True:
+                print(f"{name}: ok")
+    finally:
+        cursor.close()
+        conn.close()
+    return ok
+
+def claim_job_with_commit(conn, cursor, run_name, worker, stale_minutes, max_attempts):
+    job = jobs.claim_job(cursor, run_name, worker, stale_minutes, max_attempts)
+    conn.commit()
+    return job
+
+# Main script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert OSM addresses into mrag_ca_addresses")
+    parser.add_argument('command', nargs='?', choices=['import', 'plan', 'work', 'install-changelog', 'sync', 'preflight', 'extract', 'load'], default='import',
+                        help="import the whole table in this process (import), split it into jobs (plan), process planned jobs (work), "
+                             "install the planet_osm_polygon changelog trigger (install-changelog), process the logged changes (sync), "
+                             "check the query plans and indexes (preflight), dump the address rows to Parquet (extract) "
+                             "or merge the --output file of --sink copy-file into mrag_ca_addresses (load)")
+    parser.add_argument('--scan', choices=['keyset', 'offset', 'stream'], default='keyset',
+                        help="page by osm_id (keyset), with LIMIT/OFFSET (offset) or through one server-side cursor (stream)")
+    parser.add_argument('--source', choices=['db', 'parquet'], default='db',
+                        help="read the address rows from planet_osm_polygon (db) or from the extract in --parquet-dir (parquet)")
+    parser.add_argument('--parquet-dir', default='extract', help="directory of the Parquet extract")
+    parser.add_argument('--parquet-geometry', action='store_true', help="include the polygons in the extract")
+    parser.add_argument('--rows-per-file', type=int, default=1000000, help="rows per Parquet file of the extract")
+    parser.add_argument('--batch-size', type=int, default=1000, help="rows per page and commit")
+    parser.add_argument('--itersize', type=int, default=5000, help="rows fetched per round trip in stream mode")
+    parser.add_argument('--writer', choices=['copy', 'rows'], default='copy',
+                        help="COPY batches through a staging table (copy) or upsert row by row (rows)")
+    parser.add_argument('--sink', choices=['postgres', 'parquet', 'copy-file', 'dry-run'], default='postgres',
+                        help="upsert into mrag_ca_addresses (postgres), write the --output Parquet file (parquet) or COPY file (copy-file), "
+                             "or only transform (dry-run); the file sinks and dry-run are for import only")
+    parser.add_argument('--output', help="file written by --sink parquet and copy-file, and read by load")
+    parser.add_argument('--geometry', choices=['client', 'server'], default='client',
+                        help="send the polygon through this script (client) or copy it inside the database (server, needs --writer copy)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker processes for the address transformation (0 runs it in this process)")
+    parser.add_argument('--transform', choices=['columns', 'rows'], default='columns',
+                        help="normalize each page column by column, every distinct value once (columns), or row by row (rows)")
+    parser.add_argument('--boundaries', choices=['query', 'batch', 'memory'], default='query',
+                        help="find missing region/city with one query per address (query), one query per batch (batch) or in an in-memory STRtree (memory)")
+    parser.add_argument('--street-cache-size', type=int, default=100000,
+                        help="normalized street names and house numbers kept in the LRU caches of each process (0 disables them)")
+    parser.add_argument('--run', default='default', help="name of the run, used for checkpoints and by plan and work")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue the run after its last committed batch (keyset and stream scans)")
+    parser.add_argument('--jobs', type=int, default=256, help="number of osm_id ranges created by plan")
+    parser.add_argument('--processes', type=int, default=1, help="job processes started by work, each with its own connection")
+    parser.add_argument('--stale-minutes', type=int, default=30,
+                        help="work takes over running jobs without a heartbeat for this many minutes")
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help="work retries a failed job until it was claimed this many times")
+    parser.add_argument('--metrics-log', help="append the per-stage timings as JSON lines to this file")
+    parser.add_argument('--metrics-textfile', help="write the per-stage timings to this Prometheus textfile")
+    parser.add_argument('--metrics-interval', type=int, default=60, help="seconds between two writes of the metrics")
+    parser.add_argument('--profile', help="write a cProfile of a window of batches to this file")
+    parser.add_argument('--profile-skip', type=int, default=10, help="batches before the profiled window")
+    parser.add_argument('--profile-batches', type=int, default=20, help="batches in the profiled window")
+    parser.add_argument('--create-indexes', action='store_true',
+                        help="let preflight create the missing indexes concurrently")
+    parser.add_argument('--large-table-mb', type=int, default=10,
+                        help="preflight reports sequential scans on tables of at least this many megabytes, TOAST included")
+    parser.add_argument('--region', default='Ontario', help="region used by preflight to explain the ca_postcodes query")
+    args = parser.parse_args()
+    if args.geometry == 'server' and args.writer != 'copy':
+        parser.error("--geometry server needs --writer copy")
+    if args.resume and args.scan == 'offset':
+        parser.error("--resume needs --scan keyset or --scan stream")
+    if args.sink != 'postgres' and args.command != 'import':
+        parser.error(f"--sink {args.sink} can only be used with import")
+    if args.sink != 'postgres' and args.resume:
+        parser.error("--resume needs --sink postgres")
+    if (args.sink in ('parquet', 'copy-file') or args.command == 'load') and not args.output:
+        parser.error("--output is required")
+    set_street_cache_size(args.street_cache_size)
+    configure_metrics(args)
+
+    if args.command == 'extract':
+        run_extract(args)
+    elif args.command == 'load':
+        run_load(args)
+    elif args.command == 'preflight':
+        sys.exit(0 if run_preflight(args) else 1)
+    elif args.command == 'plan':
+        run_plan(args)
+    elif args.command == 'install-changelog':
+        run_install_changelog(args)
+    elif args.command == 'sync':
+        run_sync(args)
+    elif args.command == 'work':
+        if args.processes > 1:
+            processes = [multiprocessing.Process(target=run_worker, args=(args, i)) for i in range(args.processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        else:
+            run_worker(args)
+        conn = connect_db()
+        try:
+            for row in jobs.job_summary(conn.cursor(cursor_factory=RealDictCursor), args.run):
+                print(f"{row['status']}: {row['jobs']} jobs, {row['rows_done']} rows")
+        finally:
+            conn.close()
+    else:
+        run_import(args)
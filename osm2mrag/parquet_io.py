@@ -0,0 +1,136 @@
+# Parquet extract of the address rows of planet_osm_polygon. `extract` writes
+# them once, sorted by osm_id and split into files of a fixed number of rows;
+# `--source parquet` then reads the files memory-mapped instead of querying
+# the database, so normalization rules can be rerun without the source tables.
+
+import os
+import glob
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+FILE_PATTERN = 'addresses-*.parquet'
+
+SCHEMA = pa.schema([
+    ('osm_id', pa.int64()),
+    ('street', pa.string()),
+    ('postcode', pa.string()),
+    ('housenumber', pa.string()),
+    ('state', pa.string()),
+    ('province', pa.string()),
+    ('city', pa.string()),
+    ('longitude', pa.float64()),
+    ('latitude', pa.float64()),
+])
+
+# The polygon is kept as EWKB, so it still carries its SRID
+GEOMETRY_SCHEMA = SCHEMA.append(pa.field('way', pa.binary()))
+
+def extract_files(directory):
+    return sorted(glob.glob(os.path.join(directory, FILE_PATTERN)))
+
+def _row(row, geometry):
+    if geometry and row['way'] is not None:
+        row = dict(row, way=bytes(row['way']))
+    return row
+
+# Write the pages (lists of rows ordered by osm_id) into files of rows_per_file
+# rows. Returns the number of rows written.
+def write_extract(directory, pages, rows_per_file, geometry=False, row_group_size=100000, on_page=None):
+    if extract_files(directory):
+        raise Exception(f"{directory} already holds an extract, remove it or choose another --parquet-dir")
+    os.makedirs(directory, exist_ok=True)
+    schema = GEOMETRY_SCHEMA if geometry else SCHEMA
+
+    writer = None
+    in_file = 0
+    written = 0
+    try:
+        for rows in pages:
+            while rows:
+                if writer is None:
+                    path = os.path.join(directory, f"addresses-{written // rows_per_file:05d}.parquet")
+                    writer = pq.ParquetWriter(path, schema)
+                    in_file = 0
+                chunk = rows[:rows_per_file - in_file]
+                rows = rows[len(chunk):]
+                writer.write_table(pa.Table.from_pylist([_row(row, geometry) for row in chunk], schema=schema),
+                                   row_group_size=row_group_size)
+                in_file += len(chunk)
+                written += len(chunk)
+                if in_file >= rows_per_file:
+                    writer.close()
+                    writer = None
+            if on_page is not None:
+                on_page(written)
+    finally:
+        if writer is not None:
+            writer.close()
+    return written
+
+def has_geometry(directory):
+    files = extract_files(directory)
+    return bool(files) and 'way' in pq.read_schema(files[0]).names
+
+def count_rows(directory):
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in extract_files(directory))
+
+def _to_rows(batch):
+    rows = batch.to_pylist()
+    if 'way' in batch.schema.names:
+        # Same hex EWKB text as the way column of the database query
+        for row in rows:
+            if row['way'] is not None:
+                row['way'] = row['way'].hex().upper()
+    return rows
+
+# (min, max) osm_id of a row group from the statistics written with the file,
+# (None, None) when there are none
+def _osm_id_range(row_group):
+    for index in range(row_group.num_columns):
+        column = row_group.column(index)
+        if column.path_in_schema == 'osm_id':
+            if column.statistics is not None and column.statistics.has_min_max:
+                return column.statistics.min, column.statistics.max
+            break
+    return None, None
+
+# Pages of up to `limit` rows in osm_id order, like iter_address_pages, read
+# memory-mapped. The osm_id bounds work as in get_addresses_after. As the
+# extract is in osm_id order, row groups (and so files) before after_osm_id are
+# not read and reading stops after until_osm_id, so a job reads its own range.
+def iter_pages(directory, limit, after_osm_id=None, until_osm_id=None, geometry=True):
+    files = extract_files(directory)
+    if not files:
+        raise Exception(f"No extract in {directory}, run 'python main.py extract --parquet-dir {directory}' first")
+    columns = None if geometry else SCHEMA.names
+    for path in files:
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        row_groups = []
+        done = False
+        for index in range(parquet_file.metadata.num_row_groups):
+            low, high = _osm_id_range(parquet_file.metadata.row_group(index))
+            if until_osm_id is not None and low is not None and low > until_osm_id:
+                done = True
+                break
+            if after_osm_id is not None and high is not None and high <= after_osm_id:
+                continue
+            row_groups.append(index)
+        if row_groups:
+            for batch in parquet_file.iter_batches(batch_size=limit, row_groups=row_groups, columns=columns):
+                if until_osm_id is not None and pc.min(batch['osm_id']).as_py() > until_osm_id:
+                    return
+                if after_osm_id is not None:
+                    batch = batch.filter(pc.greater(batch['osm_id'], after_osm_id))
+                if until_osm_id is not None:
+                    batch = batch.filter(pc.less_equal(batch['osm_id'], until_osm_id))
+                if batch.num_rows:
+                    yield _to_rows(batch)
+        if done:
+            return
+
+# Schema of the output columns written by sinks.ParquetSink
+def output_schema(columns):
+    types = {'id': pa.int64(), 'geo_latitude': pa.float64(), 'geo_longitude': pa.float64()}
+    return pa.schema([(column, types.get(column, pa.string())) for column in columns])
@@ -0,0 +1,78 @@
+# Checks run by `python main.py preflight` before a long import. Every hot query
+# of osm2mrag and ca_postcodes is EXPLAINed and sequential scans on large tables
+# are reported; the indexes the queries need can be created CONCURRENTLY.
+
+# The filter of ca_postcodes/work_queue.fill_queue, without its DISTINCT
+PENDING_POSTAL_CODES_QUERY = """
+    SELECT street_no, street_full_name, city, region
+    FROM public.mrag_ca_addresses
+    WHERE postal_code IS NULL AND is_valid = true AND region = %s
+"""
+
+# Indexes the importers depend on and that neither osm2pgsql nor the
+# CREATE TABLE statements in the README create
+def required_indexes(address_filter):
+    return [
+        {
+            'name': 'planet_osm_polygon_idx_addresses',
+            'table': 'planet_osm_polygon',
+            'definition': f"ON planet_osm_polygon (osm_id) WHERE {address_filter}",
+        },
+        {
+            'name': 'mrag_boundary_data_idx_by_bound',
+            'table': 'mrag_boundary_data',
+            'definition': "ON mrag_boundary_data USING gist (bound)",
+        },
+        {
+            'name': 'mrag_ca_addresses_idx_pending_postal_codes',
+            'table': 'mrag_ca_addresses',
+            'definition': "ON mrag_ca_addresses (region) WHERE postal_code IS NULL AND is_valid = true",
+        },
+    ]
+
+# Returns None when the index does not exist, otherwise whether it is valid.
+# A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind.
+def index_status(cursor, name):
+    cursor.execute("""
+        SELECT i.indisvalid AS valid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+    """, (name,))
+    row = cursor.fetchone()
+    return None if row is None else row['valid']
+
+def table_exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS found", (table,))
+    return cursor.fetchone()['found']
+
+# Needs a connection in autocommit mode, CONCURRENTLY cannot run in a transaction
+def create_index(cursor, index):
+    if index_status(cursor, index['name']) is False:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index['name']}")
+    cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index['name']} {index['definition']}")
+    cursor.execute(f"ANALYZE {index['table']}")
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+# Size on disk including TOAST: a few thousand boundary polygons are small in
+# rows but large in bytes, and every scan reads them
+def table_bytes(cursor, table):
+    cursor.execute("SELECT pg_table_size(to_regclass(%s)) AS bytes", (table,))
+    return cursor.fetchone()['bytes'] or 0
+
+# EXPLAIN (without ANALYZE) the query and return the tables of at least
+# min_bytes that it reads with a sequential scan, as (table, bytes) tuples
+def sequential_scans(cursor, query, params, min_bytes):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cursor.fetchone()['QUERY PLAN'][0]['Plan']
+    scans = []
+    for node in _plan_nodes(plan):
+        if node['Node Type'] == 'Seq Scan':
+            size = table_bytes(cursor, node['Relation Name'])
+            if size >= min_bytes:
+                scans.append((node['Relation Name'], size))
+    return scans
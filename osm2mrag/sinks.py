@@ -0,0 +1,77 @@
+# Output sinks for the transformed batches besides the mrag_ca_addresses upsert
+# (PostgresSink in main.py). Every sink has write(addresses), close() and
+# stats(); the address tuples are in the order of main.WRITE_COLUMNS.
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+def copy_value(value):
+    # Text format of COPY
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_line(values):
+    return '\t'.join(copy_value(value) for value in values) + '\n'
+
+# COPY text file with a trailing seq column, ready for `python main.py load`
+class CopyFileSink:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.rows = 0
+
+    def write(self, addresses):
+        for address in addresses:
+            self.file.write(copy_line(address + (self.rows,)))
+            self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+    def stats(self):
+        return [f"Wrote {self.rows} rows to {self.path}, load them with 'python main.py load --output {self.path}'"]
+
+# One Parquet file; batches are collected into row groups of row_group_size rows
+class ParquetSink:
+    def __init__(self, path, schema, row_group_size=100000):
+        self.path = path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, schema)
+        self.buffer = []
+        self.rows = 0
+
+    def _flush(self):
+        if self.buffer:
+            columns = zip(*self.buffer)
+            arrays = [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)]
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+            self.buffer = []
+
+    def write(self, addresses):
+        self.buffer.extend(addresses)
+        self.rows += len(addresses)
+        if len(self.buffer) >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+    def stats(self):
+        return [f"Wrote {self.rows} rows to {self.path}"]
+
+# Measures the pipeline without writing anything
+class DryRunSink:
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, addresses):
+        self.rows += len(addresses)
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return [f"Dry run: {self.rows} rows transformed, nothing written"]
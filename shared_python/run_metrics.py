@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Per-stage timers shared by the importers. Every stage (fetch, transform,
+# write, ...) records its durations and rows; the totals, rows/sec and the
+# p50/p95/p99 of the recent durations are written periodically as JSON lines
+# and as a Prometheus textfile (node_exporter textfile collector format).
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+class StageTimers:
+    """Durations and row counts per stage.
+
+    Percentiles are computed over the last ``window`` durations of a stage, the
+    totals over the whole run. Nothing is written until ``configure`` gives a
+    log file or a textfile. Threads of one process can share an instance.
+    """
+
+    def __init__(self, program, window=1000):
+        self.program = program
+        self.window = window
+        self.stages = {}
+        self.labels = {}
+        self.log_path = None
+        self.textfile_path = None
+        self.interval = 60
+        self.started = time.time()
+        self.last_emit = time.monotonic()
+        self.lock = threading.Lock()
+        self.emit_lock = threading.Lock()
+
+    def configure(self, log_path=None, textfile_path=None, interval=60, **labels):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+        self.interval = interval
+        self.labels = labels
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'rows': 0, 'seconds': 0.0, 'recent': deque(maxlen=self.window)}
+        return stage
+
+    def record(self, name, seconds, rows=0):
+        with self.lock:
+            stage = self._stage(name)
+            stage['calls'] += 1
+            stage['rows'] += rows
+            stage['seconds'] += seconds
+            stage['recent'].append(seconds)
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, rows)
+
+    def iterate(self, name, iterable):
+        # Times every next() of the iterable, e.g. the page queries of a generator
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start, len(item))
+            yield item
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            snapshot = [(name, dict(stage, recent=list(stage['recent']))) for name, stage in self.stages.items()]
+        for name, stage in snapshot:
+            recent = sorted(stage['recent'])
+            stages[name] = {
+                'calls': stage['calls'],
+                'rows': stage['rows'],
+                'seconds': stage['seconds'],
+                'rows_per_sec': stage['rows'] / stage['seconds'] if stage['seconds'] else 0.0,
+                'p50': _percentile(recent, 0.50),
+                'p95': _percentile(recent, 0.95),
+                'p99': _percentile(recent, 0.99),
+            }
+        return stages
+
+    def maybe_emit(self):
+        if time.monotonic() - self.last_emit >= self.interval:
+            self.emit()
+
+    def emit(self):
+        with self.lock:
+            self.last_emit = time.monotonic()
+        summary = self.summary()
+        # One thread writes at a time, the others keep recording
+        with self.emit_lock:
+            if self.log_path:
+                self._write_log(summary)
+            if self.textfile_path:
+                self._write_textfile(summary)
+
+    def _write_log(self, summary):
+        now = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        with open(self.log_path, 'a') as file:
+            for name, stage in summary.items():
+                record = {'time': now, 'program': self.program, **self.labels, 'stage': name,
+                          'elapsed': round(time.time() - self.started, 3), **stage}
+                file.write(json.dumps(record) + '\n')
+
+    def _write_textfile(self, summary):
+        prefix = self.program
+        labels = ''.join(f',{key}="{value}"' for key, value in self.labels.items())
+        lines = [
+            f"# HELP {prefix}_stage_seconds Duration of one call of a stage, over the recent calls",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for name, stage in summary.items():
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"{labels}}} {stage[key]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"{labels}}} {stage["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"{labels}}} {stage["calls"]}')
+        lines.append(f"# HELP {prefix}_stage_rows_total Rows handled by a stage")
+        lines.append(f"# TYPE {prefix}_stage_rows_total counter")
+        for name, stage in summary.items():
+            lines.append(f'{prefix}_stage_rows_total{{stage="{name}"{labels}}} {stage["rows"]}')
+        # Written next to the target and renamed, so the collector never reads half a file
+        temporary = self.textfile_path + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.textfile_path)
+
+    def report(self):
+        lines = []
+        for name, stage in self.summary().items():
+            lines.append(f"{name}: {stage['calls']} calls, {stage['rows']} rows in {stage['seconds']:.1f}s "
+                         f"({stage['rows_per_sec']:.0f} rows/s), p50 {stage['p50'] * 1000:.1f}ms, "
+                         f"p95 {stage['p95'] * 1000:.1f}ms, p99 {stage['p99'] * 1000:.1f}ms")
+        return lines
+
+
+class BatchProfiler:
+    """cProfile of a window of batches, written to ``path`` in pstats format.
+
+    ``batch_done`` is called after every batch: profiling starts after the
+    first ``skip`` batches (at least one) and stops after ``batches`` more.
+    cProfile only sees the thread that starts it, so it is started by
+    ``batch_done`` in the thread that processes the batches.
+    """
+
+    def __init__(self, path, skip=10, batches=20):
+        self.path = path
+        self.skip = max(skip, 1)
+        self.batches = batches
+        self.done = 0
+        self.profile = None
+
+    def _start(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def batch_done(self):
+        self.done += 1
+        if self.done == self.skip:
+            self._start()
+        elif self.done == self.skip + self.batches:
+            self.close()
+
+    def close(self):
+        # Also called at the end of a run that was shorter than the window
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+
+
+def per_process_path(path, position):
+    # Processes started side by side write their own files, e.g. metrics-1.prom
+    if path is None:
+        return None
+    root, extension = os.path.splitext(path)
+    return f"{root}-{position}{extension}"
@@ -0,0 +1,193 @@
+import re
+from collections import OrderedDict
+
+# Both importers describe street types as a dict of r"\s<token>\s" regexes.
+# Splitting an address on whitespace means each pattern can only ever match
+# one whole token, so the tables are compiled once into hash lookups keyed by
+# token instead of running every regex against every token.
+
+WHITESPACE_SPLIT = re.compile(r'(\s+)')
+
+# Characters that re.IGNORECASE treats as equal although str.lower() does not.
+_IGNORECASE_FIXES = str.maketrans({'ı': 'i', 'ſ': 's', 'ẛ': 'ṡ'})
+
+_REGEX_SPECIALS = set('.^$*+?{}[]\\|()')
+
+
+def _has_specials(text):
+    return any(ch in _REGEX_SPECIALS for ch in text)
+
+
+def _fold(text):
+    # Character-by-character lowercasing, the same way re.IGNORECASE compares
+    if text.isascii():
+        return text.lower()
+    return ''.join(ch.lower()[:1] for ch in text).translate(_IGNORECASE_FIXES)
+
+
+class StreetTypeTable:
+    """Token -> street type lookup compiled from a REPLACEMENTS style dict.
+
+    The first pattern (in dict order) that matches a token wins, exactly as the
+    original loop over ``re.search`` did. Plain words go into a dict, words
+    ending in a ``.`` wildcard (e.g. ``Ave.``) into a dict keyed by everything
+    but the last character, and anything else falls back to a compiled regex.
+    """
+
+    def __init__(self, replacements, overrides=None, ignore_case=False):
+        self.ignore_case = ignore_case
+        self._exact = {}
+        self._any_last = {}
+        self._patterns = []
+
+        flags = re.IGNORECASE if ignore_case else 0
+        for rank, (pattern, street_type) in enumerate(replacements.items()):
+            # Overrides only replace the value of keys already in the table
+            if overrides and pattern in overrides:
+                street_type = overrides[pattern]
+            street_type = street_type.strip()
+
+            body = pattern[2:-2] if pattern.startswith(r'\s') and pattern.endswith(r'\s') else None
+            if body is not None and not _has_specials(body):
+                # Multi-word keys can never match a single whitespace free token
+                if not re.search(r'\s', body):
+                    self._exact.setdefault(self._key(body), (rank, street_type))
+            elif body is not None and body.endswith('.') and not _has_specials(body[:-1]):
+                if not re.search(r'\s', body):
+                    self._any_last.setdefault(self._key(body[:-1]), (rank, street_type))
+            else:
+                self._patterns.append((rank, re.compile(pattern, flags), street_type))
+
+    def _key(self, token):
+        return _fold(token) if self.ignore_case else token
+
+    def lookup(self, token):
+        """Return the normalized street type for ``token`` or None."""
+        if not token:
+            return None
+        key = self._key(token)
+        best = self._exact.get(key)
+        hit = self._any_last.get(key[:-1])
+        if hit is not None and (best is None or hit[0] < best[0]):
+            best = hit
+        if self._patterns:
+            padded = ' ' + token + ' '
+            for rank, pattern, street_type in self._patterns:
+                if best is not None and rank > best[0]:
+                    break
+                if pattern.search(padded):
+                    best = (rank, street_type)
+                    break
+        return best[1] if best is not None else None
+
+
+def compile_directions(replacements):
+    """Compile a DIRECTIONS_REPLACEMENTS style dict, keeping its order."""
+    return [(re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in replacements.items()]
+
+
+def convert_direction(address, directions):
+    # Only the first matching direction pattern is applied
+    for pattern, replacement in directions:
+        if pattern.search(address):
+            return pattern.sub(replacement, address)
+    return address
+
+
+def split_street_type(address, table, directions):
+    """Normalize the street type of ``address`` in a single backward pass.
+
+    Returns ``(updated_address, street_name, street_type, street_quad)``.
+    ``directions`` is the collection of quadrant tokens such as ``NE``.
+    """
+    parts = WHITESPACE_SPLIT.split(address)
+
+    # Find the index of the first comma
+    comma_index = None
+    for i, part in enumerate(parts):
+        if ',' in part:
+            comma_index = i
+            break
+
+    # Find the index of the direction (search from back to front)
+    direction_index = None
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i].strip() in directions:
+            direction_index = i
+            break
+
+    # Search from the comma (or the end) backwards for the street type
+    start_index = comma_index if comma_index is not None else len(parts) - 1
+    target_index = None
+    street_type = None
+    for i in range(start_index, -1, -1):
+        street_type = table.lookup(parts[i].strip())
+        if street_type is not None:
+            target_index = i
+            parts[i] = street_type
+            break
+
+    updated_address = ''.join(parts)
+    street_quad = parts[direction_index] if direction_index is not None else None
+
+    # Extract the street name excluding the street type and direction parts
+    street_name_parts = [part for i, part in enumerate(parts) if i != target_index and i != direction_index]
+    street_name = ''.join(street_name_parts).strip()
+
+    return updated_address, street_name, street_type, street_quad
+
+
+class LRUCache:
+    """Size bounded least-recently-used cache that counts hits, misses and evictions.
+
+    A ``maxsize`` of 0 disables caching, every lookup is then a miss.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get_or_compute(self, key, compute, *args):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(*args)
+            if self.maxsize > 0:
+                self._data[key] = value
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+            return value
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self._data) > max(maxsize, 0):
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def take_counters(self):
+        """Return (hits, misses, evictions) since the last call and reset them."""
+        counters = (self.hits, self.misses, self.evictions)
+        self.hits = self.misses = self.evictions = 0
+        return counters
+
+    def add_counters(self, counters):
+        hits, misses, evictions = counters
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions ({rate:.1%} hit rate)"